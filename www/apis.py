@@ -7,7 +7,7 @@ __author__ = 'Liuyzh'
 JSON API definition.
 '''
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 class Page(object):
     '''
@@ -58,6 +58,81 @@ class Page(object):
 
     __repr__ = __str__
 
+def encode_cursor(direction, key):
+    '''
+    Encode direction ('next' or 'prev') and key (created_at, id) as an opaque cursor string.
+    >>> c = encode_cursor('next', (1500000000.5, '001'))
+    >>> decode_cursor(c)
+    ('next', (1500000000.5, '001'))
+    '''
+    s = json.dumps([direction, key[0], key[1]], separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    '''
+    Decode cursor string to (direction, key). Raise APIValueError if cursor is invalid.
+    >>> decode_cursor('bad') # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+        ...
+    APIValueError: invalid cursor.
+    >>> decode_cursor(encode_cursor('next', ({'a': 1}, []))) # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+        ...
+    APIValueError: invalid cursor.
+    '''
+    direction = value = pk = None
+    try:
+        s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        direction, value, pk = json.loads(s)
+    except Exception as e:
+        pass
+    #value和pk来自客户端，会作为sql参数，只接受数字和字符串
+    if direction not in ('next', 'prev') or isinstance(value, bool) or not isinstance(value, (int, float)) or not isinstance(pk, str):
+        raise APIValueError('cursor', 'invalid cursor.')
+    return direction, (value, pk)
+
+class CursorPage(object):
+    '''
+    Cursor page object for keyset pagination on (created_at, id).
+    '''
+
+    def __init__(self, items, has_more, direction='next', page_size=10, has_cursor=False):
+        '''
+        Init CursorPage by items (ordered by created_at desc) of current page.
+        has_more tells whether there are more items in the direction of the request.
+        >>> items = [dict(created_at=3.0, id='c'), dict(created_at=2.0, id='b')]
+        >>> p1 = CursorPage(items, True)
+        >>> p1.has_next, p1.has_previous
+        (True, False)
+        >>> decode_cursor(p1.next_cursor)
+        ('next', (2.0, 'b'))
+        >>> p1.prev_cursor is None
+        True
+        >>> p2 = CursorPage(items, False, 'prev', has_cursor=True)
+        >>> p2.has_next, p2.has_previous
+        (True, False)
+        >>> decode_cursor(p2.next_cursor)
+        ('next', (2.0, 'b'))
+        >>> p3 = CursorPage([], False, 'next', has_cursor=True)
+        >>> p3.has_next, p3.has_previous, p3.next_cursor
+        (False, False, None)
+        '''
+        self.page_size = page_size
+        self.item_count = len(items)
+        if direction == 'prev':
+            self.has_previous = has_more
+            self.has_next = has_cursor and len(items) > 0
+        else:
+            self.has_next = has_more
+            self.has_previous = has_cursor and len(items) > 0
+        self.next_cursor = encode_cursor('next', (items[-1]['created_at'], items[-1]['id'])) if self.has_next else None
+        self.prev_cursor = encode_cursor('prev', (items[0]['created_at'], items[0]['id'])) if self.has_previous else None
+
+    def __str__(self):
+        return 'item_count: %s, page_size: %s, has_next: %s, has_previous: %s' % (self.item_count, self.page_size, self.has_next, self.has_previous)
+
+    __repr__ = __str__
+
 class APIError(Exception):
     '''
     the base APIError which contains error(required), data(optional) and message(optional).
@@ -10,7 +10,7 @@ async web application.
 import logging
 logging.basicConfig(level=logging.INFO)
 
-import asyncio, os, json, time
+import asyncio, os, json, signal, time
 from datetime import datetime
 
 from aiohttp import web
@@ -19,10 +19,11 @@ from jinja2 import Environment, FileSystemLoader
 
 from config import configs
 
-import orm
+import orm, render, writebehind
 from coroweb import add_routes, add_static
 
-from handlers import cookie2user, COOKIE_NAME
+from handlers import cookie2user, count_comments, COOKIE_NAME
+from models import Comment, MODELS
 
 #初始化jinja2模板，配置jinja2环境
 def init_jinja2(app, **kw):
@@ -63,6 +64,8 @@ def init_jinja2(app, **kw):
 async def logger_factory(app, handler):
     async def logger(request):
         logging.info('Request: %s %s' % (request.method, request.path))
+        #慢查询日志中记录发起查询的请求
+        orm.set_caller('%s %s' % (request.method, request.path))
         #await asyncio.sleep(0.3)
         return (await handler(request))
     return logger
@@ -77,11 +80,20 @@ async def auth_factory(app, handler):
             if user:
                 logging.info('set current user: %s' % user.email)
                 request.__user__ = user
+                #同一用户写入后的读取走主库
+                orm.set_session(user.id)
         if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
             return web.HTTPFound('/signin')
         return (await handler(request))
     return auth
 
+#为每个请求开启orm的标识映射，同一请求内按主键加载的行共享同一个实例
+async def identity_map_factory(app, handler):
+    async def identity_map(request):
+        with orm.identity_map():
+            return (await handler(request))
+    return identity_map
+
 #当请求方法为POST时才有效，与reques的__data__属性有关
 async def data_factory(app, handler):
     async def parse_data(request):
@@ -95,6 +107,12 @@ async def data_factory(app, handler):
         return (await handler(request))
     return parse_data
 
+#json序列化: orm.Row等使用__slots__的对象没有__dict__，通过_asdict()转换
+def json_default(o):
+    if hasattr(o, '_asdict'):
+        return o._asdict()
+    return o.__dict__
+
 #把URL函数的返回内容处理成web.Response类型
 async def response_factory(app, handler):
     async def response(request):
@@ -125,7 +143,7 @@ async def response_factory(app, handler):
             template = r.get('__template__')
             #若不存在对应模板，则调整r为json格式作为响应body，并设置响应类型
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8'))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             #存在对应模板，则套用模板
@@ -168,22 +186,49 @@ def datetime_filter(t):
 
 async def init(loop):
     #创建数据库连接池
-    await orm.create_pool(loop=loop, **configs.db)
+    db = dict(configs.db)
+    health_check_interval = db.pop('health_check_interval', 30)
+    await orm.create_pool(loop=loop, **db)
+    #预热连接池并在后台检查空闲连接
+    await orm.warmup()
+    orm.start_health_check(health_check_interval)
+    #sqlite后端(如内存数据库)启动时按Model建表
+    if configs.db.get('backend') == 'sqlite':
+        await orm.create_tables(MODELS)
+    orm.configure_count_cache(**configs.count_cache)
+    orm.configure_query_cache(**configs.query_cache)
+    orm.configure_query_stats(**configs.slow_query)
+    render.configure_render_cache(**configs.render_cache)
+    #启动并预热markdown渲染进程池
+    await render.start_render_pool(**configs.render_pool)
+    writebehind.start_buffer(Comment, after_flush=count_comments, **configs.comment_buffer)
     #初始化app，包括loop，middlewares
     #logger_factory处理请求，response_factory处理响应
-    app = web.Application(loop=loop, middlewares=[
-        logger_factory, auth_factory, response_factory
-        ])
+    middlewares = [logger_factory, auth_factory, response_factory]
+    #配置中启用时才为每个请求开启标识映射
+    if configs.identity_map.enabled:
+        middlewares.insert(1, identity_map_factory)
+    app = web.Application(loop=loop, middlewares=middlewares)
     #初始化jinja2模板
     init_jinja2(app, filters=dict(datetime=datetime_filter))
     #注册URL函数
     add_routes(app, 'handlers')
     add_static(app)
     #监听127.0.0.1的9000端口的访问请求
-    srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)
+    #客户端断开连接时取消处理请求的任务，正在执行的sql会被终止(见orm.MySQLConnection._run)
+    srv = await loop.create_server(app.make_handler(handler_cancellation=True), '127.0.0.1', 9000)
     logging.info('server started at http://127.0.0.1:9000...')
     return srv
 
 loop = asyncio.get_event_loop()
 loop.run_until_complete(init(loop))
-loop.run_forever()
+#收到SIGTERM或Ctrl+C时停止，写入缓冲中的评论后再退出
+loop.add_signal_handler(signal.SIGTERM, loop.stop)
+try:
+    loop.run_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    orm.stop_health_check()
+    loop.run_until_complete(writebehind.flush_all())
+    render.stop_render_pool()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks for orm, run without a MySQL server.
+
+python3 benchmark.py [name ...]
+'''
+
+__author__ = 'Liuyzh'
+
+import asyncio, sys, time, timeit, tracemalloc
+
+import orm
+from models import User, Blog, Comment, MODELS
+
+#用内存中的行代替数据库，并统计select的往返次数
+class FakeDatabase(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.round_trips = 0
+
+    async def select(self, sql, args, size=None, cache=False, timeout=None):
+        self.round_trips = self.round_trips + 1
+        #模拟一次网络往返
+        await asyncio.sleep(0.001)
+        rs = [dict(r) for r in self.rows if r['id'] in args]
+        return rs[:size] if size else rs
+
+def make_users(n):
+    return [dict(id='%050d' % i, email='u%s@example.com' % i, passwd='x', admin=False, name='u%s' % i, image='', created_at=time.time()) for i in range(n)]
+
+#并发find: 每个"请求"加载若干个用户，比较逐条查询和PkLoader合并后的往返次数
+def bench_find(concurrency=200, per_request=3):
+    db = FakeDatabase(make_users(100))
+    select, orm.select = orm.select, db.select
+
+    async def one_by_one(i):
+        for j in range(per_request):
+            pk = '%050d' % ((i + j) % 100)
+            rs = await orm.select('%s where `id`=?' % User.__select__, [pk], 1)
+
+    async def request(i):
+        for j in range(per_request):
+            user = await User.find('%050d' % ((i + j) % 100))
+
+    loop = asyncio.get_event_loop()
+    t0 = time.time()
+    loop.run_until_complete(asyncio.gather(*[one_by_one(i) for i in range(concurrency)]))
+    t1 = time.time()
+    naive = db.round_trips
+    db.round_trips = 0
+    loop.run_until_complete(asyncio.gather(*[request(i) for i in range(concurrency)]))
+    t2 = time.time()
+    print('find: %s requests x %s lookups' % (concurrency, per_request))
+    print('  one by one: %6d round trips, %.3fs' % (naive, t1 - t0))
+    print('  PkLoader:   %6d round trips, %.3fs' % (db.round_trips, t2 - t1))
+    orm.select = select
+
+#比较dict子类Model和紧凑行对象Row: 每行内存占用和属性访问速度
+def bench_rows(n=100000):
+    rows = make_users(n)
+    for name, make in (('Model', User.fromRow), ('Row', User.__row__.fromRow)):
+        tracemalloc.start()
+        objs = [make(r) for r in rows]
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        obj = objs[0]
+        t = timeit.timeit(lambda: (obj.id, obj.name, obj.email, obj.created_at), number=200000)
+        print('%-6s %6d bytes/row, %.3fus per 4 attribute reads' % (name, size // n, t / 200000 * 1e6))
+        del objs
+
+#使用内存中的sqlite后端跑一遍常用的orm操作，测量吞吐量，可以在CI中比较
+def bench_sqlite(n=2000):
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        await orm.create_pool(loop, backend='sqlite', path=':memory:')
+        await orm.create_tables(MODELS)
+        blogs = [Blog(user_id='u', user_name='u', user_image='', name='blog %s' % i, summary='s', content='c' * 1000) for i in range(n)]
+        t0 = time.time()
+        await Blog.save_all(blogs)
+        t1 = time.time()
+        for b in blogs[:n // 2]:
+            await Comment(blog_id=b.id, user_id='u', user_name='u', user_image='', content='hi').save()
+        t2 = time.time()
+        found = await asyncio.gather(*[Blog.find(b.id) for b in blogs])
+        t3 = time.time()
+        cursor = None
+        pages = 0
+        while True:
+            items, has_more = await Blog.findKeyset('created_at', 10, cursor)
+            pages = pages + 1
+            if not has_more:
+                break
+            cursor = (items[-1].created_at, items[-1].id)
+        t4 = time.time()
+        for b in found[:n // 2]:
+            b.summary = 'changed'
+            await b.update()
+        t5 = time.time()
+        rows = 0
+        async for b in Blog.iter_all(batch=100, compact=True):
+            rows = rows + 1
+        t6 = time.time()
+        assert len([b for b in found if b is not None]) == n and rows == n
+        assert await Blog.findNumber('count(id)') == n
+        print('sqlite: %s blogs' % n)
+        for name, t in (('save_all', t1 - t0), ('save', t2 - t1), ('find', t3 - t2), ('keyset pages', t4 - t3), ('update', t5 - t4), ('iter_all', t6 - t5)):
+            print('  %-13s %.3fs' % (name, t))
+        print('  %s keyset pages' % pages)
+
+    loop.run_until_complete(run())
+
+BENCHMARKS = dict(find=bench_find, rows=bench_rows, sqlite=bench_sqlite)
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS.keys())
+    for name in names:
+        BENCHMARKS[name]()
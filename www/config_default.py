@@ -10,13 +10,75 @@ __author__ = 'Liuyzh'
 configs = {
         'debug': True,
         'db': {
+            #mysql或sqlite，sqlite用于没有MySQL服务器时测试，path为数据库文件或':memory:'
+            'backend': 'mysql',
+            'path': ':memory:',
             'host': '127.0.0.1',
             'port': 3306,
             'user': 'root',
             'password': 'password',
-            'db': 'awesome'
+            'db': 'awesome',
+            #只读副本，如[{'host': '10.0.0.2'}]，未给出的参数沿用主库的配置
+            'replicas': [],
+            #round_robin或least_busy
+            'replica_policy': 'round_robin',
+            #写入后多少秒内同一会话的读取走主库
+            'read_your_writes': 1.0,
+            'minsize': 1,
+            'maxsize': 10,
+            #获取连接的超时时间(秒)
+            'acquire_timeout': 10,
+            #select/execute的默认超时时间(秒)，超时后终止服务器上的语句，None表示不限制
+            'statement_timeout': 10,
+            #空闲连接的最长复用时间(秒)，-1表示不限制
+            'pool_recycle': 3600,
+            #后台检查空闲连接的间隔(秒)
+            'health_check_interval': 30
             },
         'session': {
-            'secret': 'Awesome'
+            'secret': 'Awesome',
+            'cache_ttl': 300,
+            'cache_size': 10000
+            },
+        'render_pool': {
+            'workers': 2,
+            'max_pending': 32,
+            'timeout': 5,
+            'inline_size': 4096
+            },
+        'render_cache': {
+            'maxsize': 1000,
+            'maxbytes': 33554432
+            },
+        'comment_buffer': {
+            #评论的写缓冲，攒够max_size条或等待interval秒后合并写入
+            'enabled': False,
+            'max_size': 100,
+            'interval': 0.5,
+            #True时等评论写入数据库后再返回
+            'durable': False,
+            #等待写入的评论的上限，写入失败后重试的最长间隔(秒)
+            'max_pending': 10000,
+            'max_backoff': 30
+            },
+        'identity_map': {
+            #同一请求内按主键加载的行共享同一个实例，默认关闭
+            'enabled': False
+            },
+        'slow_query': {
+            #超过threshold秒的语句写入慢查询日志
+            'threshold': 0.1,
+            #是否对最慢的select执行explain
+            'explain': False,
+            'log_size': 100
+            },
+        'query_cache': {
+            'ttl': 5,
+            'maxsize': 1000
+            },
+        'count_cache': {
+            'ttl': 10,
+            'maxsize': 1024,
+            'approximate': []
             }
         }
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Recompute blogs.comment_count from the comments table.
+
+For an existing database add the column first:
+
+alter table blogs add `comment_count` bigint not null default 0 after `content`;
+
+python3 counters.py [batch]
+'''
+
+__author__ = 'Liuyzh'
+
+import asyncio, logging, sys
+
+import orm
+from models import Blog
+
+#按主键分批校正，每批一条update，只改写与评论表不一致的行
+#相关子查询按blog_id计数，使用comments上的(blog_id, created_at)索引
+_RECONCILE_SQL = 'update `blogs` set `comment_count`=(select count(`id`) from `comments` where `comments`.`blog_id`=`blogs`.`id`) where `id` in (%s) and `comment_count`<>(select count(`id`) from `comments` where `comments`.`blog_id`=`blogs`.`id`)'
+
+async def reconcile_comment_counts(batch=500):
+    changed = 0
+    ids = []
+    async for blog in Blog.iter_all(orderBy='id', batch=batch, compact=True):
+        ids.append(blog.id)
+        if len(ids) >= batch:
+            changed = changed + await _reconcile_batch(ids)
+            ids = []
+    if ids:
+        changed = changed + await _reconcile_batch(ids)
+    logging.info('reconcile done: %s blogs changed.' % changed)
+    return changed
+
+async def _reconcile_batch(ids):
+    rows = await orm.execute(_RECONCILE_SQL % orm.create_args_string(len(ids)), ids)
+    for pk in ids:
+        orm.notify_write(Blog, pk)
+    return rows
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    batch = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    from config import configs
+
+    async def main(loop):
+        await orm.create_pool(loop=loop, **configs.db)
+        await reconcile_comment_counts(batch)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop))
@@ -7,15 +7,19 @@ __author__ = 'Liuyzh'
 
 import re, time, json, logging, hashlib, base64, asyncio
 
-import markdown2
+from collections import OrderedDict
 
 from aiohttp import web
 
 from coroweb import get, post
-from apis import Page, APIValueError, APIResourceNotFoundError, APIError
+from apis import Page, CursorPage, decode_cursor, APIValueError, APIResourceNotFoundError, APIPermissionError, APIError
 
-from models import User, Comment, Blog, next_id
+import orm
+from models import User, Comment, Blog, BlogHtml, next_id
+from render import get_blog_html, save_blog_html, render_cache_stats
+from writebehind import BufferFull, get_buffer, buffer_stats
 from config import configs
+import indexes
 
 COOKIE_NAME = 'awesession'
 _COOKIE_KEY = configs.session.secret
@@ -34,6 +38,12 @@ def get_page_index(page_str):
         p = 1
     return p
 
+#游标分页，cursor为空字符串时返回第一页
+async def get_cursor_page(model, cursor, page_size=10, where=None, args=None):
+    direction, key = decode_cursor(cursor) if cursor else ('next', None)
+    items, has_more = await model.findKeyset('created_at', page_size, key, direction == 'prev', where, args)
+    return CursorPage(items, has_more, direction, page_size, key is not None), items
+
 def user2cookie(user, max_age):
     '''
     Generate cookie str by user.
@@ -48,12 +58,75 @@ def text2html(text):
     lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
     return ''.join(lines)
 
+class SessionCache(object):
+    '''
+    LRU cache of validated users keyed by cookie string, with ttl.
+    '''
+
+    def __init__(self, ttl=300, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # cookie_str ==> (expires, uid, user dict):
+        self._data = OrderedDict()
+        # uid ==> set of cookie_str:
+        self._uids = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cookie_str):
+        item = self._data.get(cookie_str)
+        if item is None or item[0] < time.time():
+            if item is not None:
+                self._pop(cookie_str)
+            self.misses = self.misses + 1
+            return None
+        self._data.move_to_end(cookie_str)
+        self.hits = self.hits + 1
+        # return a copy so callers can modify it:
+        return User(**item[2])
+
+    def put(self, cookie_str, user, expires):
+        if self.ttl <= 0:
+            return
+        self._pop(cookie_str)
+        self._data[cookie_str] = (min(time.time() + self.ttl, expires), user.id, dict(user))
+        self._uids.setdefault(user.id, set()).add(cookie_str)
+        while len(self._data) > self.maxsize:
+            self._pop(next(iter(self._data)))
+
+    def invalidate(self, uid):
+        for cookie_str in list(self._uids.get(uid, ())):
+            self._pop(cookie_str)
+
+    def _pop(self, cookie_str):
+        item = self._data.pop(cookie_str, None)
+        if item is not None:
+            cookies = self._uids.get(item[1])
+            cookies.discard(cookie_str)
+            if not cookies:
+                del self._uids[item[1]]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self._data), maxsize=self.maxsize, ttl=self.ttl, hits=self.hits, misses=self.misses, hit_ratio=(self.hits / total if total else 0.0))
+
+_session_cache = SessionCache(configs.session.get('cache_ttl', 300), configs.session.get('cache_size', 10000))
+
+def _on_write(model, pk):
+    if model is User:
+        _session_cache.invalidate(pk)
+
+orm.add_write_listener(_on_write)
+
 async def cookie2user(cookie_str):
     '''
     Parse cookie and load user if cookie is valid.
     '''
     if not cookie_str:
         return None
+    user = _session_cache.get(cookie_str)
+    if user is not None:
+        return user
     try:
         L = cookie_str.split('-')
         if len(L) != 3:
@@ -68,7 +141,10 @@ async def cookie2user(cookie_str):
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
+        #复制一份再隐藏密码，不修改标识映射中的实例
+        user = User(**user)
         user.passwd = '******'
+        _session_cache.put(cookie_str, user, int(expires))
         return user
     except Exception as e:
         logging.exception(e)
@@ -82,24 +158,46 @@ async def index(*, page='1'):
     if num == 0:
         blogs = []
     else:
-        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
+        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit), cache=True)
     return {
         '__template__': 'blogs.html',
         'page': page,
         'blogs': blogs
     }
 
+#博客的评论，按游标分页，每页COMMENT_PAGE_SIZE条
+COMMENT_PAGE_SIZE = 20
+
+#启用了评论的写缓冲时，在第一页前面加上还未写入数据库的评论，kw为过滤条件
+def with_pending_comments(comments, **kw):
+    buf = get_buffer(Comment)
+    if buf is None:
+        return comments
+    ids = set(c.id for c in comments)
+    #复制一份，不修改缓冲中的实例
+    return [Comment(**c) for c in reversed(buf.pending(**kw)) if c.id not in ids] + comments
+
+async def get_blog_comments(blog_id, cursor=''):
+    p, comments = await get_cursor_page(Comment, cursor, COMMENT_PAGE_SIZE, 'blog_id=?', [blog_id])
+    if not cursor:
+        comments = with_pending_comments(comments, blog_id=blog_id)
+    for c in comments:
+        c.html_content = text2html(c.content)
+    return p, comments
+
 @get('/blog/{id}')
 async def get_blog(id):
     blog = await Blog.find(id)
-    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
-    for c in comments:
-        c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    #只在服务器端渲染第一页评论，其余由页面通过/api/blogs/{id}/comments加载
+    p, comments = await get_blog_comments(id)
+    blog.html_content = await get_blog_html(blog)
     return {
         '__template__': 'blog.html',
         'blog': blog,
-        'comments': comments
+        'comments': comments,
+        'comment_page': p
     }
 
 @get('/register')
@@ -189,13 +287,25 @@ def manage_users(*, page='1'):
     }
 
 @get('/api/comments')
-async def api_comments(*, page='1'):
+async def api_comments(*, page='1', cursor=None):
+    if cursor is not None:
+        p, comments = await get_cursor_page(Comment, cursor)
+        if not cursor:
+            comments = with_pending_comments(comments)
+        return dict(page=p, comments=comments)
     page_index = get_page_index(page)
     num = await Comment.findNumber('count(id)')
     p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, comments=())
-    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    comments = []
+    if num > 0:
+        comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), cache=True)
+    if page_index == 1:
+        comments = with_pending_comments(comments)
+    return dict(page=p, comments=comments)
+
+@get('/api/blogs/{id}/comments')
+async def api_blog_comments(id, *, cursor=''):
+    p, comments = await get_blog_comments(id, cursor)
     return dict(page=p, comments=comments)
 
 @post('/api/blogs/{id}/comments')
@@ -209,20 +319,50 @@ async def api_create_comment(id, request, *, content):
     if blog is None:
         raise APIResourceNotFoundError('Blog')
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
-    await comment.save()
+    buf = get_buffer(Comment)
+    if buf is None:
+        async with orm.transaction():
+            await comment.save()
+            await Blog.increment(blog.id, 'comment_count')
+    else:
+        #评论数在写入评论的同一个事务中更新，见count_comments
+        try:
+            await buf.add(comment)
+        except BufferFull:
+            raise APIError('comment:busy', 'content', 'Too many comments are waiting to be saved, please try again later.')
     return comment
 
+#写缓冲写入一批评论后更新各博客的评论数
+async def count_comments(comments):
+    counts = OrderedDict()
+    for c in comments:
+        counts[c.blog_id] = counts.get(c.blog_id, 0) + 1
+    for blog_id, n in counts.items():
+        await Blog.increment(blog_id, 'comment_count', n)
+
 @post('/api/comments/{id}/delete')
 async def api_delete_comments(id, request):
     check_admin(request)
-    c = await Comment.find(id)
-    if c is None:
-        raise APIResourceNotFoundError('Comment')
-    await c.remove()
+    #还在写缓冲中的评论直接从队列中删除，正在写入的评论等写入完成后再从数据库删除
+    buf = get_buffer(Comment)
+    if buf is not None and await buf.discard(id):
+        return dict(id=id)
+    #在事务中读取，使用主库，能读到刚由写缓冲写入的评论
+    async with orm.transaction():
+        c = await Comment.find(id)
+        if c is None:
+            raise APIResourceNotFoundError('Comment')
+        if await c.remove() == 1:
+            await Blog.increment(c.blog_id, 'comment_count', -1)
     return dict(id=id)
 
 @get('/api/users')
-async def api_get_users(*, page='1'):
+async def api_get_users(*, page='1', cursor=None):
+    if cursor is not None:
+        p, users = await get_cursor_page(User, cursor)
+        for u in users:
+            u.passwd = '******'
+        return dict(page=p, users=users)
     page_index = get_page_index(page)
     num = await User.findNumber('count(id)')
     p = Page(num, page_index)
@@ -233,6 +373,41 @@ async def api_get_users(*, page='1'):
         u.passwd = '******'
     return dict(page=p, users=users)
 
+@get('/api/stats/sessions')
+def api_session_stats(request):
+    check_admin(request)
+    return _session_cache.stats()
+
+@get('/api/stats/render')
+def api_render_stats(request):
+    check_admin(request)
+    return render_cache_stats()
+
+@get('/api/stats/indexes')
+async def api_index_stats(request):
+    check_admin(request)
+    return await indexes.report()
+
+@get('/api/stats/buffers')
+def api_buffer_stats(request):
+    check_admin(request)
+    return buffer_stats()
+
+@get('/api/stats/pool')
+def api_pool_stats(request):
+    check_admin(request)
+    return orm.pool_stats()
+
+@get('/api/stats/sql')
+def api_sql_stats(request):
+    check_admin(request)
+    return orm.query_stats()
+
+@get('/api/stats/queries')
+def api_query_stats(request):
+    check_admin(request)
+    return orm.query_cache_stats()
+
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 
@@ -260,13 +435,16 @@ async def api_register_user(*, email, name, passwd):
     return r
 
 @get('/api/blogs')
-async def api_blogs(*, page='1'):
+async def api_blogs(*, page='1', cursor=None):
+    if cursor is not None:
+        p, blogs = await get_cursor_page(Blog, cursor)
+        return dict(page=p, blogs=blogs)
     page_index = get_page_index(page)
     num = await Blog.findNumber('count(id)')
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, blogs=())
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), cache=True)
     return dict(page=p, blogs=blogs)
 
 @get('/api/blogs/{id}')
@@ -285,6 +463,7 @@ async def api_create_blog(request, *, name, summary, content):
         raise APIValueError('content', 'content cannot be empty.')
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
     await blog.save()
+    await save_blog_html(blog)
     return blog
 
 @post('/api/blogs/{id}')
@@ -301,6 +480,7 @@ async def api_update_blog(id, request, *, name, summary, content):
     blog.summary = summary.strip()
     blog.content = content.strip()
     await blog.update()
+    await save_blog_html(blog, await BlogHtml.find(id))
     return blog
 
 @post('/api/blogs/{id}/delete')
@@ -308,4 +488,7 @@ async def api_delete_blog(request, *, id):
     check_admin(request)
     blog = await Blog.find(id)
     await blog.remove()
+    blog_html = await BlogHtml.find(id)
+    if blog_html is not None:
+        await blog_html.remove()
     return dict(id=id)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Generate DDL from model definitions and check live indexes against them.
+
+python3 indexes.py ddl
+python3 indexes.py check
+'''
+
+__author__ = 'Liuyzh'
+
+import asyncio, logging, re, sys
+
+import orm
+from orm import create_table_sql, index_sql
+from models import MODELS
+
+#where子句中参与比较的字段名，如 `blog_id`=? 或 created_at < ?
+_RE_WHERE_COLUMN = re.compile(r'`?(\w+)`?\s*(?:=|<|>|!=|\s+in\b|\s+like\b|\s+between\b|\s+is\b)', re.IGNORECASE)
+#order by子句中的第一个字段名
+_RE_ORDER_COLUMN = re.compile(r'^\s*`?(\w+)`?')
+
+#为已有的表补建索引
+def create_index_sql(model, index):
+    return 'alter table `%s` add %s;' % (model.__table__, index_sql(index))
+
+#读取表上实际存在的索引，返回{索引名: (字段元组, 是否唯一)}，不含主键
+async def live_indexes(model):
+    rs = await orm.select('show index from `%s`' % model.__table__, [])
+    columns = dict()
+    unique = dict()
+    for r in sorted(rs, key=lambda r: (r['Key_name'], r['Seq_in_index'])):
+        if r['Key_name'] == 'PRIMARY':
+            continue
+        columns.setdefault(r['Key_name'], []).append(r['Column_name'])
+        unique[r['Key_name']] = not r['Non_unique']
+    return dict((name, (tuple(cols), unique[name])) for name, cols in columns.items())
+
+#比较声明的索引和实际的索引，返回(缺少的Index列表, 多余的索引名列表)
+async def check_indexes(model):
+    live = await live_indexes(model)
+    missing = []
+    for index in model.__indexes__:
+        if live.get(index.name) != (index.columns, index.unique):
+            missing.append(index)
+    declared = set(map(lambda i: i.name, model.__indexes__))
+    extra = [name for name in live.keys() if name not in declared]
+    return missing, extra
+
+#查询形状是否有索引可用: 某个索引(或主键)的第一个字段出现在where中，
+#或没有where时order by的第一个字段是某个索引的第一个字段
+def is_covered(model, where, orderBy):
+    if not where and not orderBy:
+        return True
+    firsts = set([model.__primary_key__])
+    for index in model.__indexes__:
+        firsts.add(index.columns[0])
+    if where:
+        columns = set(_RE_WHERE_COLUMN.findall(where))
+        return len(columns & firsts) > 0
+    m = _RE_ORDER_COLUMN.match(orderBy)
+    return m is not None and m.group(1) in firsts
+
+#本进程中findAll/iter_all执行过、但没有索引可用的查询形状
+def uncovered_shapes():
+    L = []
+    for (model, where, orderBy), count in orm.query_shapes.items():
+        if not is_covered(model, where, orderBy):
+            L.append(dict(table=model.__table__, where=where, orderBy=orderBy, count=count))
+    return sorted(L, key=lambda d: -d['count'])
+
+#检查所有Model，返回报告
+async def report():
+    tables = []
+    for model in MODELS:
+        missing, extra = await check_indexes(model)
+        tables.append(dict(table=model.__table__, missing=[create_index_sql(model, i) for i in missing], extra=extra))
+    return dict(tables=tables, uncovered=uncovered_shapes())
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in ('ddl', 'check'):
+        print('Usage: python3 indexes.py ddl|check')
+        exit(0)
+    if argv[0] == 'ddl':
+        for model in MODELS:
+            print(create_table_sql(model))
+            print()
+        exit(0)
+
+    from config import configs
+
+    async def main(loop):
+        await orm.create_pool(loop=loop, **configs.db)
+        r = await report()
+        for t in r['tables']:
+            print('%s: %s missing, %s extra' % (t['table'], len(t['missing']), len(t['extra'])))
+            for sql in t['missing']:
+                print('  %s' % sql)
+            for name in t['extra']:
+                print('  extra index: %s' % name)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop))
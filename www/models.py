@@ -2,14 +2,14 @@
 # -*- coding: utf-8 -*-
 
 '''
-Models for user. blog, comment.
+Models for user. blog, comment, blog html.
 '''
 
 __author__ = 'Liuyzh'
 
 import time, uuid
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, InterField, FloatField, TextField, Index
 
 #生成一个和当前时间有关的id
 def next_id():
@@ -22,7 +22,7 @@ class User(Model):
     #定义id为主键，调用next_id方法后获得默认值
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     #邮箱
-    email = StringField(ddl='varchar(50)')
+    email = StringField(ddl='varchar(50)', unique=True)
     #密码
     passwd = StringField(ddl='varchar(50)')
     #管理员身份
@@ -32,7 +32,7 @@ class User(Model):
     #头像
     image = StringField(ddl='varchar(500)')
     #创建时间
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 class Blog(Model):
     __table__ = 'blogs'
@@ -48,13 +48,17 @@ class Blog(Model):
     name = StringField(ddl='varchar(50)')
     #文章概要
     summary = StringField(ddl='varchar(200)')
-    #文章正文
-    content = TextField()
+    #文章正文，列表页不需要，延迟加载
+    content = TextField(ddl='mediumtext', deferred=True)
+    #评论数，创建和删除评论时在同一个事务中更新，可以用counters.py校正
+    comment_count = InterField(default=0)
     #创建时间
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 class Comment(Model):
     __table__ = 'comments'
+    #get_blog按blog_id查询评论并按created_at排序
+    __indexes__ = [Index('blog_id', 'created_at')]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     #博客id
@@ -66,6 +70,21 @@ class Comment(Model):
     #评论者上传的图片
     user_image = StringField(ddl='varchar(500)')
     #评论内容
-    content = TextField()
+    content = TextField(ddl='mediumtext')
+    created_at = FloatField(default=time.time, index=True)
+
+
+#博客正文预先渲染好的html，id与博客id相同
+class BlogHtml(Model):
+    __table__ = 'blog_html'
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    #渲染时正文的sha1，正文改变后需要重新渲染
+    content_hash = StringField(ddl='varchar(40)')
+    #渲染器版本，渲染器升级后需要重新渲染
+    renderer = StringField(ddl='varchar(50)')
+    html = TextField(ddl='mediumtext')
     created_at = FloatField(default=time.time)
 
+#所有Model，用于建表和索引检查
+MODELS = [User, Blog, Comment, BlogHtml]
@@ -3,7 +3,9 @@
 
 __author__ = 'Liuyzh'
 
-import asyncio, logging
+import asyncio, logging, functools, time, contextlib, contextvars, re, sqlite3
+
+from collections import OrderedDict, deque
 
 import aiomysql
 
@@ -11,13 +13,98 @@ import aiomysql
 def log(sql, args=()):
     logging.info('SQL: %s' % sql)
 
-#创建全局连接池变量__pool
-#需要连接数据库时直接从__pool中获取连接
+#把sql中的?占位符翻译成aiomysql使用的%s
+#引号(' " `)内的?原样保留，%不论在引号内外都转义成%%
+#ModelMetaclass生成的语句在类创建时就翻译好，findAll等动态语句由lru_cache缓存，最多保留maxsize条
+@functools.lru_cache(maxsize=512)
+def translate(sql):
+    r'''
+    Translate ? placeholders to %s, keep ? inside quotes and escape every % as %%.
+    >>> print(translate('select * from `users` where `email`=? and `admin`=?'))
+    select * from `users` where `email`=%s and `admin`=%s
+    >>> print(translate("select * from `blogs` where `name`='why?' and `id`=?"))
+    select * from `blogs` where `name`='why?' and `id`=%s
+    >>> print(translate(r"select * from `blogs` where `name`='it\'s ?' and `id`=?"))
+    select * from `blogs` where `name`='it\'s ?' and `id`=%s
+    >>> print(translate('select `a?b` from `t?` where `id`=?'))
+    select `a?b` from `t?` where `id`=%s
+    >>> print(translate("select `id` % 2 from `blogs` where `name` like '%?%' and `id`=?"))
+    select `id` %% 2 from `blogs` where `name` like '%%?%%' and `id`=%s
+    >>> print(translate(r"select * from `blogs` where `name` like '100\%' and `id`=?"))
+    select * from `blogs` where `name` like '100\%%' and `id`=%s
+    '''
+    L = []
+    quote = None
+    i = 0
+    n = len(sql)
+    while i < n:
+        c = sql[i]
+        if quote:
+            if c == '\\' and i + 1 < n:
+                L.append(sql[i:i + 2].replace('%', '%%'))
+                i = i + 2
+                continue
+            if c == quote:
+                quote = None
+        elif c in '\'"`':
+            quote = c
+        elif c == '?':
+            c = '%s'
+        #pymysql会对整条语句做 % 格式化
+        if c == '%':
+            c = '%%'
+        L.append(c)
+        i = i + 1
+    return ''.join(L)
+
+#给select加上MAX_EXECUTION_TIME提示(MySQL 5.7.8+)，服务器端也限制执行时间，返回翻译后的语句
+#按(sql, timeout)缓存，默认的statement_timeout下每条select只拼接一次
+@functools.lru_cache(maxsize=512)
+def translate_with_timeout(sql, timeout):
+    if sql.startswith('select '):
+        sql = 'select /*+ MAX_EXECUTION_TIME(%d) */ %s' % (timeout * 1000, sql[7:])
+    return translate(sql)
+
+#数据库后端，由create_pool()根据配置创建，select/execute等函数都通过它访问数据库
+#后端提供acquire(read=False)获取连接，iterate()流式读取，approximate_count()估算行数
+#连接提供begin/commit/rollback/execute/select，sql中的占位符都是?
+_backend = None
+
+#违反主键或唯一索引等约束时各后端抛出的异常
+IntegrityError = (aiomysql.IntegrityError, sqlite3.IntegrityError)
+
+#创建全局数据库后端
+#kw['backend']为'mysql'(默认)或'sqlite'，sqlite时kw['path']为数据库文件，默认':memory:'
+#mysql时kw['replicas']为只读副本的配置列表，每个副本未给出的参数沿用主库的配置
+#select优先从副本读取，见MySQLBackend.read_pool()
 async def create_pool(loop, **kw):
-    logging.info('create database connection pool...')
     #声明为全局变量
-    global __pool
-    __pool = await aiomysql.create_pool(
+    global _backend, _read_your_writes, _statement_timeout
+    backend = kw.pop('backend', 'mysql')
+    _statement_timeout = kw.pop('statement_timeout', None)
+    if backend == 'sqlite':
+        logging.info('create sqlite database: %s...' % kw.get('path', ':memory:'))
+        _backend = SQLiteBackend(kw.get('path', ':memory:'))
+        return
+    logging.info('create database connection pool...')
+    replicas = kw.pop('replicas', None) or []
+    replica_policy = kw.pop('replica_policy', 'round_robin')
+    _read_your_writes = kw.pop('read_your_writes', 1.0)
+    acquire_timeout = kw.pop('acquire_timeout', 10)
+    pool = await _create_pool(loop, **kw)
+    L = []
+    for replica in replicas:
+        logging.info('create replica connection pool: %s:%s...' % (replica.get('host', 'localhost'), replica.get('port', 3306)))
+        conf = dict(kw)
+        conf.update(replica)
+        L.append(await _create_pool(loop, **conf))
+    _backend = MySQLBackend(pool, L, replica_policy, acquire_timeout)
+
+#select/execute的默认超时时间(秒)，None表示不限制，可以被Model的__timeout__和调用时的timeout参数覆盖
+_statement_timeout = None
+
+async def _create_pool(loop, **kw):
+    return await aiomysql.create_pool(
         host=kw.get('host', 'localhost'),
         port=kw.get('port', 3306),
         user=kw['user'],
@@ -27,47 +114,819 @@ async def create_pool(loop, **kw):
         autocommit=kw.get('autocommit', True),
         maxsize=kw.get('maxsize', 10),
         minsize=kw.get('minsize', 1),
+        #空闲超过pool_recycle秒的连接在下次取出前重建，-1表示不回收
+        pool_recycle=kw.get('pool_recycle', -1),
         loop=loop
      )
 
+#启动时预热连接池
+async def warmup():
+    await _backend.warmup()
+
+#后台定期检查空闲连接，interval单位为秒
+_health_check = None
+
+def start_health_check(interval=30):
+    global _health_check
+    async def loop():
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await _backend.check_health()
+            except Exception as e:
+                logging.exception(e)
+    _health_check = asyncio.ensure_future(loop())
+
+def stop_health_check():
+    global _health_check
+    if _health_check is not None:
+        _health_check.cancel()
+        _health_check = None
+
+def pool_stats():
+    return _backend.pool_stats()
+
+#按Model定义建表，用于sqlite后端
+async def create_tables(models):
+    await _backend.create_tables(models)
+
+#读写一致性(read-your-writes): 同一会话写入后_read_your_writes秒内的读取走主库，避免读到副本上尚未同步的旧数据
+#会话由set_session(key)指定(如用户id)，未指定时按当前请求(contextvars上下文)计算
+_read_your_writes = 1.0
+_session_key = contextvars.ContextVar('session_key', default=None)
+_last_write = contextvars.ContextVar('last_write', default=0)
+_session_writes = dict()
+
+def set_session(key):
+    _session_key.set(key)
+
+def _mark_write():
+    now = time.time()
+    _last_write.set(now)
+    key = _session_key.get()
+    if key is not None:
+        _session_writes[key] = now
+        #清理已过了读写一致窗口的会话
+        if len(_session_writes) > 10000:
+            for k, t in list(_session_writes.items()):
+                if now - t > _read_your_writes:
+                    del _session_writes[k]
+
+#当前请求或会话最近一次写入的时间
+def _last_write_time():
+    t = _last_write.get()
+    key = _session_key.get()
+    if key is not None:
+        t = max(t, _session_writes.get(key, 0))
+    return t
+
+def _recent_write():
+    return time.time() - _last_write_time() < _read_your_writes
+
+#耗时直方图，BUCKETS为各桶的上界，单位毫秒，最后一个桶记录超过5000ms的值
+class Histogram(object):
+
+    BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    #t单位为秒
+    def observe(self, t):
+        ms = t * 1000
+        i = 0
+        while i < len(self.BUCKETS) and ms > self.BUCKETS[i]:
+            i = i + 1
+        self.counts[i] = self.counts[i] + 1
+        self.count = self.count + 1
+        self.total = self.total + t
+        self.max = max(self.max, t)
+
+    def to_dict(self):
+        labels = ['<=%sms' % b for b in self.BUCKETS] + ['>%sms' % self.BUCKETS[-1]]
+        return dict(zip(labels, self.counts))
+
+#连接池统计: 获取连接的等待时间直方图、超时次数、健康检查回收的连接数
+class PoolStats(object):
+
+    def __init__(self):
+        self.wait = Histogram()
+        self.timeouts = 0
+        self.recycled = 0
+        #超时或被取消而终止的语句数
+        self.killed = 0
+
+    def observe(self, wait):
+        self.wait.observe(wait)
+
+    def to_dict(self):
+        w = self.wait
+        return dict(acquired=w.count, wait_avg=(w.total / w.count if w.count else 0.0), wait_max=w.max, timeouts=self.timeouts, recycled=self.recycled, killed=self.killed, wait_histogram=w.to_dict())
+
+#aiomysql连接
+class MySQLConnection(object):
+
+    def __init__(self, conn, backend, pool):
+        self.conn = conn
+        self.backend = backend
+        self.pool = pool
+
+    #超时或被取消后连接已关闭
+    @property
+    def closed(self):
+        return self.conn.closed
+
+    async def begin(self):
+        await self.conn.begin()
+
+    async def commit(self):
+        await self.conn.commit()
+
+    async def rollback(self):
+        #连接已关闭时服务器会自动回滚
+        if self.conn.closed:
+            return
+        await self.conn.rollback()
+
+    #在timeout秒内完成fn()，超时或被取消(如客户端断开连接)时终止服务器上的语句并关闭连接
+    async def _run(self, fn, timeout):
+        try:
+            return await asyncio.wait_for(fn(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            self.backend.cancel(self.pool, self.conn)
+            raise
+        except aiomysql.OperationalError as e:
+            #3024: 超过MAX_EXECUTION_TIME被服务器终止，连接仍可复用
+            if e.args[0] == 3024:
+                raise asyncio.TimeoutError() from e
+            raise
+
+    #执行insert，update，delete等，返回影响的行数
+    async def execute(self, sql, args, timeout=None):
+        async def run():
+            async with self.conn.cursor() as cur:
+                await cur.execute(translate(sql), args or ())
+                return cur.rowcount
+        return await self._run(run, timeout)
+
+    async def select(self, sql, args, size=None, timeout=None):
+        sql = translate_with_timeout(sql, timeout) if timeout else translate(sql)
+        async def run():
+            #创建游标
+            async with self.conn.cursor(aiomysql.DictCursor) as cur:
+                #执行sql命令，传入sql参数，包括目标表等
+                await cur.execute(sql, args or ())
+                #size是需要返回的结果数，默认返回所有查询结果
+                if size:
+                    return await cur.fetchmany(size)
+                return await cur.fetchall()
+        return await self._run(run, timeout)
+
+#MySQL后端，一个主库连接池和若干只读副本连接池
+class MySQLBackend(object):
+
+    def __init__(self, pool, replicas=(), replica_policy='round_robin', acquire_timeout=10):
+        self.pool = pool
+        self.replicas = list(replicas)
+        #round_robin或least_busy
+        self.replica_policy = replica_policy
+        self._next_replica = 0
+        #获取连接的超时时间，单位秒，超时抛出asyncio.TimeoutError
+        self.acquire_timeout = acquire_timeout
+        self.stats = PoolStats()
+
+    #选择select使用的连接池
+    #没有副本或刚写入过时使用主库，否则按replica_policy在副本中选择:
+    #round_robin轮流使用，least_busy使用正在使用的连接数最少的副本
+    def read_pool(self):
+        if not self.replicas or _recent_write():
+            return self.pool
+        if self.replica_policy == 'least_busy':
+            return min(self.replicas, key=lambda p: p.size - p.freesize)
+        pool = self.replicas[self._next_replica % len(self.replicas)]
+        self._next_replica = self._next_replica + 1
+        return pool
+
+    #从连接池获取aiomysql连接，记录等待时间，超过acquire_timeout抛出asyncio.TimeoutError
+    #record=False时不计入等待时间和超时统计，用于健康检查等后台任务
+    @contextlib.asynccontextmanager
+    async def _acquire(self, pool, record=True):
+        t = time.time()
+        try:
+            conn = await asyncio.wait_for(pool.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            if record:
+                self.stats.timeouts = self.stats.timeouts + 1
+            logging.warning('acquire connection timeout: %s in use.' % (pool.size - pool.freesize))
+            raise
+        if record:
+            self.stats.observe(time.time() - t)
+        try:
+            yield conn
+        finally:
+            pool.release(conn)
+
+    #从主库或副本的连接池中获取一个数据库连接，写操作总是使用主库
+    @contextlib.asynccontextmanager
+    async def acquire(self, read=False):
+        pool = self.read_pool() if read else self.pool
+        async with self._acquire(pool) as conn:
+            yield MySQLConnection(conn, self, pool)
+
+    #终止连接上正在执行的语句: 关闭连接，连接池释放时会丢弃已关闭的连接；
+    #服务器不会马上发现客户端已断开，再用另一个连接发出KILL QUERY，不在当前任务中等待
+    def cancel(self, pool, conn):
+        if conn.closed:
+            return
+        thread_id = conn.thread_id()
+        conn.close()
+        self.stats.killed = self.stats.killed + 1
+        logging.warning('kill query on connection %s.' % thread_id)
+        asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(self._kill(pool, thread_id)), context=contextvars.Context())
+
+    async def _kill(self, pool, thread_id):
+        try:
+            async with self._acquire(pool) as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute('kill query %d' % thread_id)
+        except Exception as e:
+            logging.warning('kill query %s failed: %s' % (thread_id, e))
+
+    #使用服务器端游标SSDictCursor，内存占用与结果集大小无关
+    async def iterate(self, sql, args, batch=100):
+        pool = self.read_pool()
+        async with self._acquire(pool) as conn:
+            cur = await conn.cursor(aiomysql.SSDictCursor)
+            finished = False
+            try:
+                await cur.execute(translate(sql), args or ())
+                while True:
+                    rs = await cur.fetchmany(batch)
+                    if not rs:
+                        break
+                    yield rs
+                finished = True
+            finally:
+                if finished:
+                    await cur.close()
+                else:
+                    #调用者提前停止或出错时，结果集没有读完，连接已不可复用
+                    #直接关闭连接并终止语句，而不是把剩余的行全部读完
+                    self.cancel(pool, conn)
+
+    #预热: 每个连接池同时取出minsize个连接并ping一次，确认数据库可用并建立好连接
+    async def warmup(self):
+        for pool in [self.pool] + self.replicas:
+            async def ping():
+                async with self._acquire(pool) as conn:
+                    await conn.ping()
+            await asyncio.gather(*[ping() for i in range(pool.minsize)])
+            logging.info('warmup connection pool: %s connections.' % pool.size)
+
+    #健康检查: ping每个空闲连接，失败的连接关闭后由连接池丢弃，请求不会拿到失效的连接
+    async def check_health(self):
+        for pool in [self.pool] + self.replicas:
+            for i in range(pool.freesize):
+                async with self._acquire(pool, False) as conn:
+                    try:
+                        await conn.ping(False)
+                    except Exception as e:
+                        logging.warning('recycle stale connection: %s' % e)
+                        conn.close()
+                        self.stats.recycled = self.stats.recycled + 1
+
+    def pool_stats(self):
+        pools = []
+        for pool in [self.pool] + self.replicas:
+            pools.append(dict(size=pool.size, in_use=pool.size - pool.freesize, idle=pool.freesize, minsize=pool.minsize, maxsize=pool.maxsize))
+        d = self.stats.to_dict()
+        d['pools'] = pools
+        return d
+
+    async def explain(self, sql, args):
+        async with self.acquire(read=True) as conn:
+            return await conn.select('explain ' + sql, args)
+
+    #从information_schema读取InnoDB估算的行数
+    async def approximate_count(self, table):
+        async with self.acquire(read=True) as conn:
+            rs = await conn.select('select `TABLE_ROWS` _num_ from `information_schema`.`TABLES` where `TABLE_SCHEMA`=database() and `TABLE_NAME`=?', [table], 1)
+        if len(rs) == 0:
+            return None
+        return rs[0]['_num_']
+
+    #按Model建表，DDL与indexes.py ddl生成的相同，已存在的表不做修改
+    async def create_tables(self, models):
+        async with self.acquire() as conn:
+            for model in models:
+                await conn.execute(create_table_sql(model, True), ())
+
+#sqlite3连接，sqlite本身使用?占位符，不需要translate
+class SQLiteConnection(object):
+
+    closed = False
+
+    def __init__(self, db, stats):
+        self.db = db
+        self.stats = stats
+
+    async def begin(self):
+        self.db.execute('begin')
+
+    async def commit(self):
+        self.db.execute('commit')
+
+    async def rollback(self):
+        self.db.execute('rollback')
+
+    #sqlite3的调用是同步的，无法被取消，用progress handler在超过timeout秒后中断语句
+    def _run(self, fn, timeout):
+        if not timeout:
+            return fn()
+        deadline = time.time() + timeout
+        self.db.set_progress_handler(lambda: time.time() > deadline, 1000)
+        try:
+            return fn()
+        except sqlite3.OperationalError as e:
+            if time.time() <= deadline:
+                raise
+            self.stats.killed = self.stats.killed + 1
+            raise asyncio.TimeoutError() from e
+        finally:
+            self.db.set_progress_handler(None, 1000)
+
+    async def execute(self, sql, args, timeout=None):
+        return self._run(lambda: self.db.execute(sql, args or ()).rowcount, timeout)
+
+    async def select(self, sql, args, size=None, timeout=None):
+        def run():
+            cur = self.db.execute(sql, args or ())
+            return cur.fetchmany(size) if size else cur.fetchall()
+        return [dict(r) for r in self._run(run, timeout)]
+
+#sqlite后端，使用标准库sqlite3，可以是内存数据库，用于没有MySQL服务器时测试和测量吞吐量
+#ModelMetaclass和findAll生成的sql(反引号、limit ?, ?、多行insert、保存点)sqlite都能执行
+#只有一个连接，用一个锁让事务独占连接，同一个任务中可以重入
+class SQLiteBackend(object):
+
+    def __init__(self, path=':memory:'):
+        #isolation_level=None: 由begin/commit显式控制事务
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self._lock = asyncio.Lock()
+        self._owner = None
+        #等待锁的时间记作获取连接的等待时间
+        self.stats = PoolStats()
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, read=False):
+        task = asyncio.current_task()
+        if self._owner is task:
+            yield SQLiteConnection(self.db, self.stats)
+            return
+        t = time.time()
+        async with self._lock:
+            self.stats.observe(time.time() - t)
+            self._owner = task
+            try:
+                yield SQLiteConnection(self.db, self.stats)
+            finally:
+                self._owner = None
+
+    #一次读出所有行再分批产出，不长时间占用连接
+    async def iterate(self, sql, args, batch=100):
+        async with self.acquire(read=True) as conn:
+            rs = await conn.select(sql, args)
+        for i in range(0, len(rs), batch):
+            yield rs[i:i + batch]
+
+    async def approximate_count(self, table):
+        async with self.acquire(read=True) as conn:
+            rs = await conn.select('select count(*) _num_ from `%s`' % table, [], 1)
+        return rs[0]['_num_']
+
+    async def explain(self, sql, args):
+        async with self.acquire(read=True) as conn:
+            return await conn.select('explain query plan ' + sql, args)
+
+    async def warmup(self):
+        pass
+
+    async def check_health(self):
+        pass
+
+    def pool_stats(self):
+        d = self.stats.to_dict()
+        d['pools'] = [dict(size=1, in_use=1 if self._lock.locked() else 0, idle=0 if self._lock.locked() else 1, minsize=1, maxsize=1)]
+        return d
+
+    #按Model的__mappings__和__indexes__建表，sqlite中索引名在整个库内唯一，加上表名前缀
+    async def create_tables(self, models):
+        async with self.acquire() as conn:
+            for model in models:
+                #sqlite不支持在create table中定义索引，表建好后逐个创建，索引名加上表名前缀避免重名
+                L = column_sql(model)
+                L.append('primary key (`%s`)' % model.__primary_key__)
+                await conn.execute('create table if not exists `%s` (%s)' % (model.__table__, ', '.join(L)), ())
+                for index in model.__indexes__:
+                    await conn.execute('create %sindex if not exists `%s_%s` on `%s` (%s)' % ('unique ' if index.unique else '', model.__table__, index.name, model.__table__, ', '.join(map(lambda c: '`%s`' % c, index.columns))), ())
+
+#select的结果缓存，需要时通过select(..., cache=True)或findAll(..., cache=True)开启
+#key为(翻译后的sql, args, size)，按ttl过期，按LRU淘汰，最多maxsize条
+#execute对某个表执行insert/update/delete后，该表相关的缓存全部失效
+_RE_SELECT_TABLES = re.compile(r'\b(?:from|join)\s+`?(\w+)`?', re.IGNORECASE)
+_RE_WRITE_TABLE = re.compile(r'^\s*(?:insert\s+into|update|delete\s+from)\s+`?(\w+)`?', re.IGNORECASE)
+
+class QueryCache(object):
+
+    def __init__(self, ttl=5, maxsize=1000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        #key ==> (过期时间, 表名集合, 结果)
+        self._data = OrderedDict()
+        #sql ==> [命中次数, 未命中次数]
+        self._stats = dict()
+
+    def _count(self, sql, hit):
+        counts = self._stats.get(sql)
+        if counts is None:
+            if len(self._stats) >= self.maxsize:
+                return
+            counts = self._stats[sql] = [0, 0]
+        counts[0 if hit else 1] += 1
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is not None and item[0] < time.time():
+            del self._data[key]
+            item = None
+        self._count(key[0], item is not None)
+        if item is None:
+            return None
+        self._data.move_to_end(key)
+        return item[2]
+
+    def put(self, key, rs):
+        if self.ttl <= 0:
+            return
+        tables = frozenset(map(lambda t: t.lower(), _RE_SELECT_TABLES.findall(key[0])))
+        self._data[key] = (time.time() + self.ttl, tables, rs)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, table):
+        table = table.lower()
+        for key in [k for k, v in self._data.items() if table in v[1]]:
+            del self._data[key]
+
+    #sql为insert/update/delete时，使该表的缓存失效
+    def invalidate_sql(self, sql):
+        m = _RE_WRITE_TABLE.match(sql)
+        if m is not None:
+            self.invalidate(m.group(1))
+
+    def stats(self):
+        L = []
+        for sql, (hits, misses) in self._stats.items():
+            L.append(dict(sql=sql, hits=hits, misses=misses, hit_ratio=hits / (hits + misses)))
+        return dict(size=len(self._data), maxsize=self.maxsize, ttl=self.ttl, queries=sorted(L, key=lambda d: -(d['hits'] + d['misses'])))
+
+_query_cache = QueryCache()
+
+def configure_query_cache(ttl=5, maxsize=1000):
+    global _query_cache
+    _query_cache = QueryCache(ttl, maxsize)
+
+def query_cache_stats():
+    return _query_cache.stats()
+
+#sql统计和慢查询日志
+#按归一化的语句(in (?, ?, ...)和多行values合并为一种)统计耗时直方图和返回/影响的行数
+#耗时超过threshold秒的语句写入慢查询日志，包括参数的类型和发起查询的请求(见set_caller)
+#explain=True时对最慢的select语句执行一次explain并保存结果
+_RE_ARGS_LIST = re.compile(r'\(\?(?:,\s*\?)+\)')
+_RE_VALUES_LIST = re.compile(r'(\(\?\.\.\.\))(?:,\s*\(\?\.\.\.\))+')
+
+@functools.lru_cache(maxsize=512)
+def normalize(sql):
+    return _RE_VALUES_LIST.sub(r'\1, ...', _RE_ARGS_LIST.sub('(?...)', sql))
+
+_caller = contextvars.ContextVar('caller', default=None)
+
+#记录当前请求，写入慢查询日志
+def set_caller(caller):
+    _caller.set(caller)
+
+class StatementStats(object):
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.rows = 0
+        self.rows_max = 0
+        #超时或被取消的次数
+        self.timeouts = 0
+        self.explain = None
+
+    def to_dict(self):
+        h = self.latency
+        return dict(count=h.count, timeouts=self.timeouts, time_total=h.total, time_avg=h.total / h.count, time_max=h.max, rows_total=self.rows, rows_avg=self.rows / h.count, rows_max=self.rows_max, latency_histogram=h.to_dict(), explain=self.explain)
+
+class QueryStats(object):
+
+    def __init__(self, threshold=0.1, explain=False, log_size=100, maxsize=1000):
+        self.threshold = threshold
+        self.explain = explain
+        self.maxsize = maxsize
+        #归一化的sql ==> StatementStats
+        self._stats = dict()
+        #最近的慢查询
+        self.slow_log = deque(maxlen=log_size)
+
+    #timed_out=True表示语句超时或被取消，没有返回结果，总是写入慢查询日志
+    def record(self, sql, args, t, rows, timed_out=False):
+        key = normalize(sql)
+        st = self._stats.get(key)
+        if st is None:
+            if len(self._stats) >= self.maxsize:
+                return
+            st = self._stats[key] = StatementStats()
+        st.latency.observe(t)
+        st.rows = st.rows + rows
+        st.rows_max = max(st.rows_max, rows)
+        if timed_out:
+            st.timeouts = st.timeouts + 1
+        elif t < self.threshold:
+            return
+        args_shape = [type(a).__name__ for a in (args or ())]
+        caller = _caller.get()
+        logging.warning('%s SQL %.1fms rows=%s caller=%s args=%s: %s' % ('TIMEOUT' if timed_out else 'SLOW', t * 1000, rows, caller, args_shape[:10], key))
+        self.slow_log.append(dict(sql=key, time=t, rows=rows, timed_out=timed_out, args=args_shape, caller=caller, at=time.time()))
+        if self.explain and st.explain is None and key.lstrip().lower().startswith('select'):
+            st.explain = []
+            #在空的context中执行，不使用当前请求的事务
+            asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(self._explain(st, sql, args)), context=contextvars.Context())
+
+    async def _explain(self, st, sql, args):
+        try:
+            st.explain = await _backend.explain(sql, args)
+        except Exception as e:
+            st.explain = [dict(error=str(e))]
+
+    def to_dict(self, top=50):
+        L = []
+        for sql, st in self._stats.items():
+            d = st.to_dict()
+            d['sql'] = sql
+            L.append(d)
+        L.sort(key=lambda d: -d['time_total'])
+        return dict(threshold=self.threshold, statements=L[:top], slow_log=list(self.slow_log))
+
+_query_stats = QueryStats()
+
+def configure_query_stats(threshold=0.1, explain=False, log_size=100, maxsize=1000):
+    global _query_stats
+    _query_stats = QueryStats(threshold, explain, log_size, maxsize)
+
+def query_stats():
+    return _query_stats.to_dict()
+
+#执行conn.select或conn.execute并计时，返回结果
+#超时或被取消的语句往往是最慢的，在finally中同样记录
+async def _timed_select(conn, sql, args, size=None, timeout=None):
+    t = time.time()
+    rs = []
+    timed_out = False
+    try:
+        rs = await conn.select(sql, args, size, timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        timed_out = True
+        raise
+    finally:
+        _query_stats.record(sql, args, time.time() - t, len(rs), timed_out)
+    return rs
+
+async def _timed_execute(conn, sql, args, timeout=None):
+    t = time.time()
+    rows = 0
+    timed_out = False
+    try:
+        rows = await conn.execute(sql, args, timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        timed_out = True
+        raise
+    finally:
+        _query_stats.record(sql, args, time.time() - t, rows, timed_out)
+    return rows
+
 #将执行sql的代码封装进select函数中，调用只需要传入sql语句和参数
-async def select(sql, args, size=None):
+#cache=True时使用结果缓存，返回的行应当只读
+#timeout为超时时间(秒)，默认使用create_pool的statement_timeout，超时抛出asyncio.TimeoutError
+async def select(sql, args, size=None, cache=False, timeout=None):
+    timeout = timeout or _statement_timeout
+    #在事务中时使用事务的连接，不使用缓存
+    tx = _transaction.get()
+    if tx is not None:
+        return await tx.select(sql, args, size, timeout)
+    if cache:
+        key = (translate(sql), tuple(args or ()), size)
+        rs = _query_cache.get(key)
+        if rs is not None:
+            return list(rs)
+        rs = await select(sql, args, size, timeout=timeout)
+        _query_cache.put(key, rs)
+        return list(rs)
     log(sql, args)
-    global __pool
-    #从__pool中获取一个数据库连接
-    async with __pool.get() as conn:
-        #创建游标
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            #执行sql命令，传入sql参数，包括目标表等
-            await cur.execute(sql.replace('?', '%s'), args or ())
-            #size是需要返回的结果数，默认返回所有查询结果
-            if size:
-                rs = await cur.fetchmany(size)
-            else:
-                rs = await cur.fetchall()
-        logging.info('row returned: %s' % len(rs))
-        return rs
+    async with _backend.acquire(read=True) as conn:
+        rs = await _timed_select(conn, sql, args, size, timeout)
+    logging.info('row returned: %s' % len(rs))
+    return rs
+
+#流式select，异步生成器，每次产出batch行
+#总是使用单独的连接，不参与transaction()
+async def select_iter(sql, args, batch=100):
+    log(sql, args)
+    it = _backend.iterate(sql, args, batch)
+    try:
+        async for rs in it:
+            yield rs
+    finally:
+        #调用者提前停止时立即关闭后端的迭代器，释放连接
+        await it.aclose()
 
 #由于insert，update，delete需要相同的参数，而且都返回一个整数表示影响的行数
 #定义一个通用函数execute包含以上三种sql
-async def execute(sql, args, autocommit=True):
+#写操作总是使用主库
+async def execute(sql, args, autocommit=True, timeout=None):
+    timeout = timeout or _statement_timeout
+    _mark_write()
+    tx = _transaction.get()
+    if tx is not None:
+        return await tx.execute(sql, args, timeout)
     log(sql)
-    with (await __pool) as conn:
+    async with _backend.acquire() as conn:
         if not autocommit:
             await conn.begin()
         try:
-            cur = await conn.cursor()
-            await cur.execute(sql.replace('?', '%s'), args)
-            affected = cur.rowcount
-            await cur.close()
+            affected = await _timed_execute(conn, sql, args, timeout)
             if not autocommit:
                 await conn.commit()
         except BaseException as e:
             if not autocommit:
                 await conn.rollback()
             raise
+        finally:
+            _query_cache.invalidate_sql(sql)
         return affected
 
+#在同一个连接的同一个事务中依次执行多条sql，statements为[(sql, args), ...]
+#返回每条sql影响的行数，任意一条失败则整体回滚
+#timeout限制每一条sql的执行时间
+async def execute_all(statements, timeout=None):
+    timeout = timeout or _statement_timeout
+    _mark_write()
+    tx = _transaction.get()
+    if tx is not None:
+        await tx.flush()
+        return [await tx._execute(sql, args, timeout) for sql, args in statements]
+    async with _backend.acquire() as conn:
+        await conn.begin()
+        try:
+            affected = []
+            for sql, args in statements:
+                log(sql)
+                affected.append(await _timed_execute(conn, sql, args, timeout))
+            await conn.commit()
+        except BaseException as e:
+            await conn.rollback()
+            raise
+        finally:
+            for sql, args in statements:
+                _query_cache.invalidate_sql(sql)
+        return affected
+
+#事务，由transaction()创建，整个事务固定使用同一个主库连接
+#事务中的select/execute/execute_all以及Model的方法都会自动使用该连接
+#batch=True时insert语句先缓存起来，在下一次读取、非insert语句、保存点或提交前再发出，
+#相同的连续insert合并成一条多行insert，减少往返次数；缓存的insert返回将要插入的行数，出错时在发出时抛出
+class Transaction(object):
+
+    def __init__(self, conn, batch=False):
+        self.conn = conn
+        self.batch = batch
+        #缓存的insert语句[(sql, args), ...]
+        self._pending = []
+        #提交后执行的回调
+        self._on_commit = []
+        self._savepoints = 0
+        #事务中的语句共用一个连接，aiomysql的连接不能同时执行两条语句，
+        #如事务中asyncio.gather(Comment.find(a), Comment.find(b))，用锁让它们依次执行
+        self._lock = asyncio.Lock()
+
+    def on_commit(self, fn):
+        self._on_commit.append(fn)
+
+    #发出一条语句，调用者需持有_lock
+    async def _send(self, sql, args, timeout=None):
+        log(sql)
+        #提交后使相关表的查询缓存失效
+        self.on_commit(lambda: _query_cache.invalidate_sql(sql))
+        return await _timed_execute(self.conn, sql, args, timeout or _statement_timeout)
+
+    async def _execute(self, sql, args, timeout=None):
+        async with self._lock:
+            return await self._send(sql, args, timeout)
+
+    async def execute(self, sql, args, timeout=None):
+        if self.batch and sql.startswith('insert '):
+            self._pending.append((sql, args))
+            #多行insert的values中有多组(...)，按第一组的占位符数计算行数
+            values = sql[sql.index(' values ') + 8:]
+            return len(args) // values[:values.index(')') + 1].count('?')
+        async with self._lock:
+            await self._flush()
+            return await self._send(sql, args, timeout)
+
+    async def select(self, sql, args, size=None, timeout=None):
+        async with self._lock:
+            await self._flush()
+            log(sql, args)
+            rs = await _timed_select(self.conn, sql, args, size, timeout)
+        logging.info('row returned: %s' % len(rs))
+        return rs
+
+    async def flush(self):
+        async with self._lock:
+            await self._flush()
+
+    #发出缓存的insert，连续的相同insert合并成一条，调用者需持有_lock
+    async def _flush(self):
+        pending, self._pending = self._pending, []
+        i = 0
+        while i < len(pending):
+            sql, args = pending[i]
+            args = list(args)
+            j = i + 1
+            while j < len(pending) and pending[j][0] == sql:
+                args.extend(pending[j][1])
+                j = j + 1
+            values = sql[sql.index(' values ') + 8:]
+            await self._send(sql + (', ' + values) * (j - i - 1), args)
+            i = j
+
+    #嵌套的transaction()使用保存点，出错时只回滚到保存点
+    @contextlib.asynccontextmanager
+    async def savepoint(self):
+        await self.flush()
+        self._savepoints = self._savepoints + 1
+        name = 'sp_%s' % self._savepoints
+        hooks = len(self._on_commit)
+        await self._execute('savepoint %s' % name, ())
+        try:
+            yield self
+            await self.flush()
+        except BaseException as e:
+            self._pending = []
+            del self._on_commit[hooks:]
+            #语句超时或被取消后连接已关闭，整个事务会被回滚
+            if not self.conn.closed:
+                await self._execute('rollback to savepoint %s' % name, ())
+            raise
+        await self._execute('release savepoint %s' % name, ())
+
+_transaction = contextvars.ContextVar('transaction', default=None)
+
+#用法:
+#async with orm.transaction() as tx:
+#    await comment.save()
+#    await blog.update()
+#块内正常结束时提交，抛出异常时回滚；嵌套使用时创建保存点
+@contextlib.asynccontextmanager
+async def transaction(batch=False):
+    tx = _transaction.get()
+    if tx is not None:
+        async with tx.savepoint():
+            yield tx
+        return
+    async with _backend.acquire() as conn:
+        await conn.begin()
+        tx = Transaction(conn, batch)
+        token = _transaction.set(tx)
+        try:
+            yield tx
+            await tx.flush()
+            await conn.commit()
+        except BaseException as e:
+            await conn.rollback()
+            raise
+        finally:
+            _transaction.reset(token)
+    for fn in tx._on_commit:
+        fn()
+
 #创建一定数量的占位符
 def create_args_string(num):
     L = []
@@ -79,7 +938,7 @@ def create_args_string(num):
 #定义字段基类
 class Field(object):
 
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, index=False, unique=False):
         #字段名
         self.name = name
         #字段类型
@@ -88,6 +947,11 @@ class Field(object):
         self.primary_key = primary_key
         #默认值
         self.default = default
+        #是否在该字段上建索引，unique=True时建唯一索引
+        self.index = index or unique
+        self.unique = unique
+        #是否延迟加载
+        self.deferred = False
     #打印相关
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.colume_type, self.name)
@@ -96,28 +960,303 @@ class StringField(Field):
 
     #ddl意为数据定义语言(data definition languages)
     #默认值为可变字符串'varchar(100)'
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', index=False, unique=False):
+        super().__init__(name, ddl, primary_key, default, index, unique)
 
 class BooleanField(Field):
 
-    def __init__(self, name=None, default=False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, 'boolean', False, default, index)
 
 class InterField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False, unique=False):
+        super().__init__(name, 'bigint', primary_key, default, index, unique)
 
 class FloatField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False, unique=False):
+        super().__init__(name, 'real', primary_key, default, index, unique)
 
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    #deferred=True时findAll默认不读取该字段，需要时通过await obj.loadValue(key)读取
+    def __init__(self, name=None, default=None, ddl='text', deferred=False):
+        super().__init__(name, ddl, False, default)
+        self.deferred = deferred
+
+#索引声明，用于Model类的__indexes__属性，如:
+#__indexes__ = [Index('blog_id', 'created_at')]
+class Index(object):
+
+    def __init__(self, *columns, name=None, unique=False):
+        if not columns:
+            raise ValueError('Index must have at least one column.')
+        self.columns = tuple(columns)
+        #默认索引名为idx_加上各字段名
+        self.name = name or 'idx_%s' % '_'.join(columns)
+        self.unique = unique
+
+    def __str__(self):
+        return '<%s%s, %s:(%s)>' % ('Unique' if self.unique else '', self.__class__.__name__, self.name, ', '.join(self.columns))
+
+    __repr__ = __str__
+
+#建表语句中的字段定义，MySQL和sqlite共用，主键定义由调用者放在最后
+def column_sql(model):
+    return ['`%s` %s not null' % (v.name or k, v.colume_type) for k, v in model.__mappings__.items()]
+
+def index_sql(index):
+    return '%skey `%s` (%s)' % ('unique ' if index.unique else '', index.name, ', '.join(map(lambda c: '`%s`' % c, index.columns)))
+
+#根据Model的__mappings__和__indexes__生成MySQL的create table语句
+#if_not_exists=True时表已存在则不做任何修改，供create_tables使用
+def create_table_sql(model, if_not_exists=False):
+    L = column_sql(model) + [index_sql(index) for index in model.__indexes__]
+    L.append('primary key (`%s`)' % model.__primary_key__)
+    return 'create table %s%s (\n    %s\n) engine=innodb default charset=utf8;' % ('if not exists ' if if_not_exists else '', model.__table__, ',\n    '.join(L))
+
+#findNumber的结果缓存，key为(表名, selectField, where, args)
+#Model.save/remove/update会按表失效缓存，不带where的count(...)在插入/删除成功时直接加减1
+class CountCache(object):
+
+    def __init__(self, ttl=10, maxsize=1024, approximate=()):
+        #ttl为0表示不缓存
+        self.ttl = ttl
+        self.maxsize = maxsize
+        #这些表的不带where的计数总是使用估算值
+        self.approximate = set(approximate)
+        #key ==> (过期时间, 值)
+        self._data = dict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[0] < time.time():
+            del self._data[key]
+            return None
+        return item[1]
+
+    def put(self, key, value):
+        if self.ttl <= 0 or value is None:
+            return
+        if len(self._data) >= self.maxsize:
+            self.clear()
+        self._data[key] = (time.time() + self.ttl, value)
+
+    #表的行数变化了delta行: 不带where的count(...)直接加上delta，delta为0(update)时不变；
+    #带where的计数和其他聚合可能因为任何写入而变化，全部删除
+    def adjust(self, table, delta):
+        for key in list(self._data.keys()):
+            if key[0] != table:
+                continue
+            expires, value = self._data[key]
+            if key[2] is None and key[1].lower().startswith('count('):
+                if delta:
+                    self._data[key] = (expires, value + delta)
+            else:
+                del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+_count_cache = CountCache()
+
+#配置findNumber的缓存，ttl单位为秒
+def configure_count_cache(ttl=10, maxsize=1024, approximate=()):
+    global _count_cache
+    _count_cache = CountCache(ttl, maxsize, approximate)
+
+#写操作完成后更新findNumber缓存并通知监听器，delta为表的行数变化
+#在事务中时等到事务提交后再执行
+def after_write(model, delta, pks):
+    def fn():
+        _count_cache.adjust(model.__table__, delta)
+        for pk in pks:
+            notify_write(model, pk)
+    tx = _transaction.get()
+    if tx is None:
+        fn()
+    else:
+        tx.on_commit(fn)
+
+#findAll/iter_all执行过的查询形状(Model类, where, orderBy) ==> 次数
+#where中的参数都是?占位符，形状的数量是有限的，最多记录MAX_QUERY_SHAPES种
+query_shapes = dict()
+MAX_QUERY_SHAPES = 1000
+
+def record_query_shape(model, where, orderBy):
+    key = (model, where, orderBy)
+    if key in query_shapes:
+        query_shapes[key] = query_shapes[key] + 1
+    elif len(query_shapes) < MAX_QUERY_SHAPES:
+        query_shapes[key] = 1
+
+#写操作监听器，Model.save/save_all/update/remove成功执行后调用fn(Model类, 主键)
+#供orm之外的缓存(如handlers中的会话缓存)失效使用
+_write_listeners = []
+
+def add_write_listener(fn):
+    _write_listeners.append(fn)
+
+def notify_write(model, pk):
+    for fn in _write_listeners:
+        try:
+            fn(model, pk)
+        except Exception as e:
+            logging.exception(e)
+
+#标识映射(identity map): 同一个请求内，同一主键的行只对应一个Model实例
+#由app.py中的identity_map_factory为每个请求开启，未开启时find/findAll行为不变
+class IdentityMap(object):
+
+    def __init__(self):
+        #(Model类, 主键) ==> 实例
+        self._data = dict()
+
+    def get(self, model, pk):
+        return self._data.get((model, pk))
+
+    #登记实例，若该主键已有实例则返回已有的实例
+    #只读取了部分字段的实例不登记，以免find()拿到不完整的实例
+    def add(self, obj):
+        key = (obj.__class__, obj.getValue(obj.__primary_key__))
+        existing = self._data.get(key)
+        if existing is not None:
+            return existing
+        if len(obj) >= len(obj.__mappings__):
+            self._data[key] = obj
+        return obj
+
+    def discard(self, model, pk):
+        self._data.pop((model, pk), None)
+
+_identity_map = contextvars.ContextVar('identity_map', default=None)
+
+#用法: with orm.identity_map(): ...
+@contextlib.contextmanager
+def identity_map():
+    token = _identity_map.set(IdentityMap())
+    try:
+        yield _identity_map.get()
+    finally:
+        _identity_map.reset(token)
+
+#按主键批量加载，即DataLoader
+#同一轮事件循环(tick)中所有load(pk)先登记到_pending，
+#由loop.call_soon在本轮结束后统一发出一条find_many查询，再把结果分发给各个等待者
+class PkLoader(object):
+
+    #每个Model类一个loader
+    _loaders = dict()
+
+    @classmethod
+    def get(cls, model):
+        loader = cls._loaders.get(model)
+        if loader is None:
+            loader = cls._loaders[model] = cls(model)
+        return loader
+
+    def __init__(self, model):
+        self._model = model
+        #pk ==> [future, ...]
+        self._pending = dict()
+        #等待者中最近一次写入的时间，批量查询据此决定是否读主库
+        self._last_write = 0
+        #等待者的请求，写入慢查询日志
+        self._callers = set()
+        #统计: 合并前的load次数和实际发出的查询次数
+        self.loads = 0
+        self.queries = 0
+
+    def load(self, pk):
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        #本轮第一个load负责安排批量查询
+        #批量查询属于多个请求，在空的context中执行，不使用任何一个请求的标识映射
+        if not self._pending:
+            loop.call_soon(self._dispatch, context=contextvars.Context())
+        self._pending.setdefault(pk, []).append(fut)
+        self._last_write = max(self._last_write, _last_write_time())
+        self._callers.add(_caller.get())
+        self.loads = self.loads + 1
+        return fut
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, dict()
+        last_write, self._last_write = self._last_write, 0
+        callers, self._callers = self._callers, set()
+        asyncio.ensure_future(self._fetch(pending, last_write, callers))
+
+    async def _fetch(self, pending, last_write, callers):
+        #任何一个等待者刚写入过时，整批都读主库
+        _last_write.set(last_write)
+        #一批查询可能来自多个请求，全部记入慢查询日志
+        callers.discard(None)
+        if callers:
+            _caller.set(', '.join(sorted(callers)))
+        self.queries = self.queries + 1
+        try:
+            rs = await self._model.find_many(list(pending.keys()))
+        except BaseException as e:
+            for futs in pending.values():
+                for fut in futs:
+                    if not fut.done():
+                        fut.set_exception(e)
+            return
+        for obj, futs in zip(rs, pending.values()):
+            for fut in futs:
+                if fut.done():
+                    continue
+                #每个等待者拿到独立的实例，避免互相修改(如cookie2user会改写passwd)
+                fut.set_result(None if obj is None else self._model.fromRow(obj))
+
+#紧凑的行对象，由ModelMetaclass为每个Model生成子类，如User.__row__
+#使用__slots__存储字段，没有dict的哈希表开销，属性访问不经过__getattr__
+#findAll/iter_all传入compact=True时返回行对象，适合大批量读取和导出
+#行对象不能保存，修改后需要写回时用toModel()
+class Row(object):
+
+    __slots__ = ()
+
+    def __init__(self, **kw):
+        for k, v in kw.items():
+            setattr(self, k, v)
+
+    @classmethod
+    def fromRow(cls, row):
+        return cls(**row)
+
+    #仍支持row['key']，供模板和CursorPage使用
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    #转为dict，供json序列化
+    def _asdict(self):
+        d = dict()
+        for k in self.__slots__:
+            try:
+                d[k] = getattr(self, k)
+            except AttributeError:
+                pass
+        return d
+
+    #转为可修改、可保存的Model实例
+    def toModel(self):
+        return self.__model__.fromRow(self._asdict())
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(map(lambda kv: '%s=%r' % kv, self._asdict().items())))
+
+#按MySQL utf8默认排序规则的主要差异折叠主键: 不区分大小写，忽略尾部空格
+def _fold_key(key):
+    if isinstance(key, str):
+        return key.rstrip(' ').lower()
+    return key
 
 #通过ModelMetaclass.__new__()创建类
 #元类的作用: 
@@ -162,6 +1301,17 @@ class ModelMetaclass(type):
         #删除类中被mappings包含了的属性
         for k in mappings.keys():
             attrs.pop(k)
+        #收集索引声明: 字段上的index/unique和类属性__indexes__
+        indexes = []
+        for k, v in mappings.items():
+            if v.index and not v.primary_key:
+                indexes.append(Index(k, unique=v.unique))
+        for index in attrs.get('__indexes__', ()):
+            for c in index.columns:
+                if c not in mappings:
+                    raise ValueError('Index %s column not found: %s' % (index.name, c))
+            indexes.append(index)
+        attrs['__indexes__'] = indexes
         #对fields中的字符串元素进行处理
         escaped_fields = list(map(lambda f: '`%s`' % f, fields))
         #把mappings存入attrs
@@ -171,10 +1321,20 @@ class ModelMetaclass(type):
         attrs['__fields__'] = fields
         #生成select，insert，update，delete四个sql语句，存入attrs
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
+        #findAll默认使用的select语句，不含延迟加载的字段
+        attrs['__select_list__'] = 'select %s from `%s`' % (', '.join(map(lambda f: '`%s`' % f, [primaryKey] + [f for f in fields if not mappings[f].deferred])), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        #只更新部分字段的update语句，由Model._update_sql()按需生成
+        attrs['__updates__'] = dict()
+        #预先翻译固定的sql语句
+        for k in ('__select__', '__select_list__', '__insert__', '__update__', '__delete__'):
+            translate(attrs[k])
+        model = type.__new__(cls, name, bases, attrs)
+        #生成紧凑行类
+        model.__row__ = type('%sRow' % name, (Row,), dict(__slots__=tuple([primaryKey] + fields), __model__=model))
+        return model
 
 #Model类继承自dict类
 #元类的作用: 
@@ -185,12 +1345,32 @@ class ModelMetaclass(type):
 #添加属性__select__、__insert__、__update__、__delete__
 class Model(dict, metaclass=ModelMetaclass):
 
+    #该Model的语句的默认超时时间(秒)，None表示使用create_pool的statement_timeout
+    __timeout__ = None
+
     def __init__(self, **kw):
         #调用 Model 父类 dict 的初始化方法
         #传入的关键字参数存入自身dict中
         #如user = User(id = 1)
         #user['id'] = 1
         super(Model, self).__init__(**kw)
+        #_dirty记录从数据库加载后被修改过的字段，update()只写这些字段
+        #None表示实例不是从数据库加载的，update()写入所有字段
+        object.__setattr__(self, '_dirty', None)
+
+    #由数据库中的一行创建实例，此时没有被修改的字段
+    @classmethod
+    def fromRow(cls, row):
+        obj = cls(**row)
+        object.__setattr__(obj, '_dirty', set())
+        return obj
+
+    #d.k=v和d['k']=v都会经过这里，值确实改变时记录被修改的字段
+    def __setitem__(self, key, value):
+        dirty = self.__dict__.get('_dirty')
+        if dirty is not None and (key not in self or self[key] != value):
+            dirty.add(key)
+        super(Model, self).__setitem__(key, value)
     
     #获取dict的值
     #user.id 等价于 user['id']
@@ -230,8 +1410,60 @@ class Model(dict, metaclass=ModelMetaclass):
     @classmethod
     async def findAll(cls, where=None, args=None, **kw):
         ' find objects by where clause. '
-        #'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
-        sql = [cls.__select__]
+        sql, args = cls._select_sql(where, args, **kw)
+        rs = await select(sql, args, cache=kw.get('cache', False), timeout=kw.get('timeout', cls.__timeout__))
+        if kw.get('compact', False):
+            return [cls.__row__.fromRow(r) for r in rs]
+        imap = _identity_map.get()
+        if imap is not None:
+            return [imap.add(cls.fromRow(r)) for r in rs]
+        return [cls.fromRow(r) for r in rs]
+
+    #流式读取，使用非缓冲的SSDictCursor，每次只从服务器取batch行
+    #用法: async for blog in Blog.iter_all(orderBy='created_at desc'):
+    @classmethod
+    async def iter_all(cls, where=None, args=None, batch=100, **kw):
+        ' iterate objects by where clause with constant memory. '
+        sql, args = cls._select_sql(where, args, **kw)
+        fromRow = cls.__row__.fromRow if kw.get('compact', False) else cls.fromRow
+        async for rs in select_iter(sql, args, batch):
+            for r in rs:
+                yield fromRow(r)
+
+    #键集(keyset)分页: 按 orderField desc, 主键 desc 排序
+    #cursor=(orderField的值, 主键)表示上一页的边界行，backward=False取其后(更旧)的行，backward=True取其前(更新)的行
+    #只走orderField上的索引，不需要像limit offset, n那样扫描并丢弃前面的offset行
+    #返回(按desc排序的对象列表, 该方向上是否还有更多行)
+    @classmethod
+    async def findKeyset(cls, orderField, limit, cursor=None, backward=False, where=None, args=None, columns=None):
+        ' find objects by keyset pagination on (orderField, primary key). '
+        pk = cls.__primary_key__
+        conditions = []
+        if where:
+            conditions.append('(%s)' % where)
+        args = list(args or [])
+        if cursor is not None:
+            op = '>' if backward else '<'
+            conditions.append('(`%s`%s? or (`%s`=? and `%s`%s?))' % (orderField, op, orderField, pk, op))
+            args.extend([cursor[0], cursor[0], cursor[1]])
+        order = 'asc' if backward else 'desc'
+        objs = await cls.findAll(' and '.join(conditions) or None, args, orderBy='`%s` %s, `%s` %s' % (orderField, order, pk, order), limit=limit + 1, columns=columns)
+        has_more = len(objs) > limit
+        objs = objs[:limit]
+        if backward:
+            objs.reverse()
+        return objs, has_more
+
+    #拼接findAll和iter_all使用的select语句
+    #columns为需要读取的字段列表(主键总是读取)，默认读取除延迟加载字段外的所有字段
+    @classmethod
+    def _select_sql(cls, where=None, args=None, **kw):
+        columns = kw.get('columns', None)
+        if columns is None:
+            #'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)，不含延迟加载字段
+            sql = [cls.__select_list__]
+        else:
+            sql = [cls._projection_sql(columns)]
         if where:
             sql.append('where')
             sql.append(where)
@@ -241,6 +1473,7 @@ class Model(dict, metaclass=ModelMetaclass):
         if orderBy:
             sql.append('order by')
             sql.append(orderBy)
+        record_query_shape(cls, where, orderBy)
         limit = kw.get('limit', None)
         if limit is not None:
             sql.append('limit')
@@ -252,50 +1485,205 @@ class Model(dict, metaclass=ModelMetaclass):
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        return ' '.join(sql), args
 
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
+    def _projection_sql(cls, columns):
+        for c in columns:
+            if c not in cls.__mappings__:
+                raise ValueError('Invalid column: %s' % c)
+        columns = [c for c in columns if c != cls.__primary_key__]
+        return 'select %s from `%s`' % (', '.join(map(lambda f: '`%s`' % f, [cls.__primary_key__] + columns)), cls.__table__)
+
+    #读取延迟加载或未投影的字段，已读取的字段直接返回
+    #如: content = await blog.loadValue('content')
+    async def loadValue(self, key):
+        if key in self:
+            return self[key]
+        if key not in self.__mappings__:
+            raise AttributeError(r"'Model' object has no attribute '%s'" % key)
+        rs = await select('select `%s` from `%s` where `%s`=?' % (key, self.__table__, self.__primary_key__), [self.getValue(self.__primary_key__)], 1, timeout=self.__timeout__)
+        if len(rs) == 0:
+            return None
+        #直接写入dict，不算作修改
+        dict.__setitem__(self, key, rs[0][key])
+        return self[key]
+
+    #approximate=True(或表在配置的approximate中)时，不带where的计数直接读information_schema中InnoDB估算的行数，不扫描索引
+    @classmethod
+    async def findNumber(cls, selectField, where=None, args=None, approximate=False):
         ' find number by select and where. '
+        if (approximate or cls.__table__ in _count_cache.approximate) and not where:
+            return await cls.findApproximateCount()
+        key = (cls.__table__, selectField, where, tuple(args or ()))
+        num = _count_cache.get(key)
+        if num is not None:
+            return num
         sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
         if where:
             sql.append('where')
             sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+        rs = await select(' '.join(sql), args, 1, timeout=cls.__timeout__)
         if len(rs) == 0:
             return None
-        return rs[0]['_num_']
+        num = rs[0]['_num_']
+        _count_cache.put(key, num)
+        return num
+
+    @classmethod
+    async def findApproximateCount(cls):
+        ' find approximate row count of table. '
+        return await _backend.approximate_count(cls.__table__)
 
     @classmethod
     async def find(cls, pk):
         ' find object by primary key. '
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
-        if len(rs) == 0:
-            return None
-        return cls(**rs[0])
+        imap = _identity_map.get()
+        if imap is not None:
+            obj = imap.get(cls, pk)
+            if obj is not None:
+                return obj
+        #同一轮事件循环中的find调用会被PkLoader合并成一条where id in (...)查询
+        #事务中需要使用事务的连接，不经过PkLoader
+        if _transaction.get() is not None:
+            obj = (await cls.find_many([pk]))[0]
+        else:
+            obj = await PkLoader.get(cls).load(pk)
+        if obj is not None and imap is not None:
+            obj = imap.add(obj)
+        return obj
+
+    @classmethod
+    async def find_many(cls, pks):
+        ' find objects by a list of primary keys, keep the order of pks and return None for missing keys. '
+        pks = list(pks)
+        if not pks:
+            return []
+        imap = _identity_map.get()
+        found = dict()
+        #去重后查询，结果再按pks的顺序展开，标识映射中已有的主键不再查询
+        keys = list(dict.fromkeys(pks))
+        if imap is not None:
+            for pk in keys:
+                obj = imap.get(cls, pk)
+                if obj is not None:
+                    found[pk] = obj
+            keys = [pk for pk in keys if pk not in found]
+        if keys:
+            rs = await select('%s where `%s` in (%s)' % (cls.__select__, cls.__primary_key__, create_args_string(len(keys))), keys, timeout=cls.__timeout__)
+            rows = dict((r[cls.__primary_key__], r) for r in rs)
+            #MySQL的utf8表比较主键时不区分大小写、忽略尾部空格，返回的主键可能与传入的不同(如find('ABC')返回'abc'的行)
+            #没有精确对应、但与某行只差大小写或尾部空格的键，按单个主键再查一次，由数据库按排序规则判断，结果与逐条查询一致
+            folded = set(map(_fold_key, rows.keys()))
+            for pk in keys:
+                if pk not in rows and _fold_key(pk) in folded:
+                    rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1, timeout=cls.__timeout__)
+                    if rs:
+                        rows[pk] = rs[0]
+            for pk, r in rows.items():
+                obj = cls.fromRow(r)
+                found[pk] = imap.add(obj) if imap is not None else obj
+        return [found.get(pk) for pk in pks]
     
     #save、updat、delete三个方法需要创建实例后调用
     async def save(self):
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
         #'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
-        rows = await execute(self.__insert__, args)
+        rows = await execute(self.__insert__, args, timeout=self.__timeout__)
+        after_write(self.__class__, 1 if rows == 1 else 0, [args[-1]])
+        object.__setattr__(self, '_dirty', set())
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
 
+    #批量插入，每chunk_size个实例拼成一条insert ... values (...), (...)
+    #所有chunk在同一个事务中执行，返回每个chunk影响的行数
+    @classmethod
+    async def save_all(cls, instances, chunk_size=500):
+        ' insert objects with multi-row insert statements in one transaction. '
+        if chunk_size < 1:
+            raise ValueError('Invalid chunk_size value: %s' % str(chunk_size))
+        instances = list(instances)
+        if not instances:
+            return []
+        columns = cls.__fields__ + [cls.__primary_key__]
+        row = ', (%s)' % create_args_string(len(columns))
+        statements = []
+        for i in range(0, len(instances), chunk_size):
+            chunk = instances[i:i + chunk_size]
+            args = []
+            for obj in chunk:
+                args.extend(map(obj.getValueOrDefault, columns))
+            #__insert__已经带有第一行的values (...)
+            statements.append((cls.__insert__ + row * (len(chunk) - 1), args))
+        affected = await execute_all(statements, cls.__timeout__)
+        after_write(cls, sum(affected), [obj.getValue(cls.__primary_key__) for obj in instances])
+        for obj in instances:
+            object.__setattr__(obj, '_dirty', set())
+        for n, (rows, (sql, args)) in enumerate(zip(affected, statements)):
+            expected = len(args) // len(columns)
+            logging.info('bulk insert chunk %s: affected rows: %s/%s' % (n, rows, expected))
+            if rows != expected:
+                logging.warn('failed to insert records: chunk %s affected rows: %s' % (n, rows))
+        return affected
+
+    #只更新某些字段的update语句，按字段组合缓存在__updates__中
+    @classmethod
+    def _update_sql(cls, fields):
+        sql = cls.__updates__.get(fields)
+        if sql is None:
+            sql = 'update `%s` set %s where `%s`=?' % (cls.__table__, ', '.join(map(lambda f: '`%s`=?' % (cls.__mappings__.get(f).name or f), fields)), cls.__primary_key__)
+            cls.__updates__[fields] = sql
+        return sql
+
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        dirty = self._dirty
+        if dirty is None:
+            fields = self.__fields__
+            #'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
+            sql = self.__update__
+        else:
+            #从数据库加载的实例只写入修改过的字段，没有修改时不访问数据库
+            fields = tuple(f for f in self.__fields__ if f in dirty)
+            if not fields:
+                logging.info('skip update: no field changed.')
+                return
+            sql = self._update_sql(fields)
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        #'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
-        rows = await execute(self.__update__, args)
+        rows = await execute(sql, args, timeout=self.__timeout__)
+        object.__setattr__(self, '_dirty', set())
+        after_write(self.__class__, 0, [args[-1]])
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
 
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
         #'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        rows = await execute(self.__delete__, args)
+        rows = await execute(self.__delete__, args, timeout=self.__timeout__)
+        imap = _identity_map.get()
+        if imap is not None:
+            imap.discard(self.__class__, args[0])
+        after_write(self.__class__, -1 if rows == 1 else 0, [args[0]])
         if rows != 1:
             logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+        return rows
+
+    #在数据库中原子地给数值字段加上n，不需要先读出实例，如计数器
+    #'update `%s` set `%s`=`%s`+? where `%s`=?' % (tableName, field, field, primaryKey)
+    @classmethod
+    async def increment(cls, pk, field, n=1):
+        ' add n to a numeric field by primary key without loading the object. '
+        name = cls.__mappings__[field].name or field
+        rows = await execute('update `%s` set `%s`=`%s`+? where `%s`=?' % (cls.__table__, name, name, cls.__primary_key__), [n, pk], timeout=cls.__timeout__)
+        #标识映射中已加载的实例同步修改，不算作修改过的字段
+        imap = _identity_map.get()
+        obj = imap.get(cls, pk) if imap is not None else None
+        if obj is not None and field in obj:
+            dict.__setitem__(obj, field, obj[field] + n)
+        after_write(cls, 0, [pk])
+        return rows
 
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
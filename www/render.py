@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Render blog content to html and store it in blog_html.
+
+python3 render.py backfill [batch]
+'''
+
+__author__ = 'Liuyzh'
+
+import asyncio, hashlib, json, logging, sys, time
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import markdown2
+
+import orm
+from models import Blog, BlogHtml
+
+#渲染器版本，升级markdown2或修改渲染参数后应修改此值，已存的html会被重新渲染
+RENDERER = 'markdown2-%s' % markdown2.__version__
+
+def content_hash(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+#markdown渲染结果的LRU缓存，key为正文和渲染参数的sha1
+#同时限制条目数maxsize和html总字节数maxbytes
+class RenderCache(object):
+
+    def __init__(self, maxsize=1000, maxbytes=32 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        #key ==> html
+        self._data = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text, kw):
+        s = json.dumps(kw, sort_keys=True, default=str)
+        return hashlib.sha1(('%s\n%s' % (s, text)).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        html = self._data.get(key)
+        if html is None:
+            self.misses = self.misses + 1
+            return None
+        self._data.move_to_end(key)
+        self.hits = self.hits + 1
+        return html
+
+    def put(self, key, html):
+        size = len(html.encode('utf-8'))
+        #单条超过总字节数限制的结果不缓存
+        if size > self.maxbytes:
+            return
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.bytes = self.bytes - len(old.encode('utf-8'))
+        self._data[key] = html
+        self.bytes = self.bytes + size
+        while len(self._data) > self.maxsize or self.bytes > self.maxbytes:
+            k, v = self._data.popitem(last=False)
+            self.bytes = self.bytes - len(v.encode('utf-8'))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self._data), maxsize=self.maxsize, bytes=self.bytes, maxbytes=self.maxbytes, hits=self.hits, misses=self.misses, hit_ratio=(self.hits / total if total else 0.0))
+
+_render_cache = RenderCache()
+
+def configure_render_cache(maxsize=1000, maxbytes=32 * 1024 * 1024):
+    global _render_cache
+    _render_cache = RenderCache(maxsize, maxbytes)
+
+def render_cache_stats():
+    return _render_cache.stats()
+
+#在当前进程或进程池的子进程中执行的渲染函数
+def _render(text, kw):
+    #markdown2返回UnicodeWithAttrs，转为普通str
+    return str(markdown2.markdown(text, **kw))
+
+#渲染进程池，由start_render_pool()在app.init()中创建
+#长文档的渲染会阻塞事件循环几十毫秒，放到子进程中执行
+class RenderPool(object):
+
+    def __init__(self, workers=2, max_pending=32, timeout=5, inline_size=4096):
+        self.workers = workers
+        self.timeout = timeout
+        #小于inline_size个字符的文档直接在当前进程渲染，省去进程间传输
+        self.inline_size = inline_size
+        self._executor = ProcessPoolExecutor(workers)
+        #限制排队的渲染任务数，超出时等待
+        self._pending = asyncio.Semaphore(max_pending)
+
+    #让每个子进程先完成一次渲染，提前启动进程并导入markdown2
+    async def warmup(self):
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*[loop.run_in_executor(self._executor, _render, '# warmup', dict()) for i in range(self.workers)])
+
+    #等待名额和渲染一共不超过timeout秒，超时抛出asyncio.TimeoutError
+    #超时只是不再等待，子进程仍在渲染，等它真正结束后才释放名额，排队的任务数始终不超过max_pending
+    #子进程意外退出(如被OOM杀掉)时重建进程池，这次在当前进程渲染
+    async def render(self, text, kw):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.timeout
+        await asyncio.wait_for(self._pending.acquire(), self.timeout)
+        executor = self._executor
+        try:
+            fut = loop.run_in_executor(executor, _render, text, kw)
+        except BaseException as e:
+            #提交失败时不会调用_done，在这里释放名额
+            self._pending.release()
+            if not isinstance(e, BrokenProcessPool):
+                raise
+            self._restart(executor)
+            return _render(text, kw)
+        fut.add_done_callback(self._done)
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), max(deadline - loop.time(), 0))
+        except BrokenProcessPool:
+            self._restart(executor)
+            return _render(text, kw)
+
+    #替换已损坏的进程池，多个任务同时发现时只替换一次
+    def _restart(self, executor):
+        if self._executor is not executor:
+            return
+        logging.warning('render pool is broken, restart it.')
+        self._executor = ProcessPoolExecutor(self.workers)
+        executor.shutdown(wait=False)
+
+    def _done(self, fut):
+        self._pending.release()
+        #读取超时后才结束的任务的异常，避免"exception was never retrieved"
+        if not fut.cancelled():
+            fut.exception()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+_render_pool = None
+
+async def start_render_pool(workers=2, max_pending=32, timeout=5, inline_size=4096):
+    global _render_pool
+    logging.info('start render pool with %s workers...' % workers)
+    _render_pool = RenderPool(workers, max_pending, timeout, inline_size)
+    await _render_pool.warmup()
+
+def stop_render_pool():
+    global _render_pool
+    if _render_pool is not None:
+        _render_pool.shutdown()
+        _render_pool = None
+
+#异步渲染，参数与markdown2.markdown相同(extras等)，所有markdown渲染都应通过此函数
+#先查缓存，未命中时长文档交给进程池，超时抛出asyncio.TimeoutError
+#进程池未启动(如在render.py backfill中)或文档较短时在当前进程渲染
+async def render_markdown(text, **kw):
+    key = RenderCache.key(text, kw)
+    html = _render_cache.get(key)
+    if html is not None:
+        return html
+    if _render_pool is None or len(text) < _render_pool.inline_size:
+        html = _render(text, kw)
+    else:
+        html = await _render_pool.render(text, kw)
+    _render_cache.put(key, html)
+    return html
+
+#判断已存的html是否与博客正文和当前渲染器一致
+def is_fresh(blog_html, blog):
+    return blog_html is not None and blog_html.renderer == RENDERER and blog_html.content_hash == content_hash(blog.content)
+
+#渲染博客正文，生成BlogHtml实例
+async def make_blog_html(blog):
+    html = await render_markdown(blog.content)
+    return BlogHtml(id=blog.id, content_hash=content_hash(blog.content), renderer=RENDERER, html=html, created_at=time.time())
+
+#渲染博客正文并保存，existing为已存的BlogHtml，返回html
+#已存的html仍是最新的(如只修改了摘要)时不重新渲染，也不写数据库
+#否则修改已加载的existing，update()只写入变化的字段，正文没变时不会重写html
+#并发的请求都没有读到已存的行(或读了落后的副本)时，插入会违反主键，改为覆盖已有的行
+async def save_blog_html(blog, existing=None):
+    if is_fresh(existing, blog):
+        return existing.html
+    blog_html = await make_blog_html(blog)
+    if existing is not None:
+        for k in ('content_hash', 'renderer', 'html', 'created_at'):
+            existing[k] = blog_html[k]
+        await existing.update()
+        return existing.html
+    try:
+        await blog_html.save()
+    except orm.IntegrityError as e:
+        logging.info('blog html %s already stored, update it.' % blog.id)
+        await blog_html.update()
+    return blog_html.html
+
+#读取博客的html，没有或已过期时重新渲染并保存
+async def get_blog_html(blog):
+    blog_html = await BlogHtml.find(blog.id)
+    if is_fresh(blog_html, blog):
+        return blog_html.html
+    logging.info('render blog html: %s' % blog.id)
+    return await save_blog_html(blog, blog_html)
+
+#为已有的博客批量生成html，跳过已是最新的行
+async def backfill(batch=100):
+    rendered = 0
+    blogs = []
+    async for blog in Blog.iter_all(orderBy='created_at', batch=batch, columns=['content']):
+        blogs.append(blog)
+        if len(blogs) >= batch:
+            rendered = rendered + await _backfill_batch(blogs)
+            blogs = []
+    if blogs:
+        rendered = rendered + await _backfill_batch(blogs)
+    logging.info('backfill done: %s blogs rendered.' % rendered)
+    return rendered
+
+async def _backfill_batch(blogs):
+    existing = await BlogHtml.find_many([b.id for b in blogs])
+    created = []
+    rendered = 0
+    for blog, blog_html in zip(blogs, existing):
+        if is_fresh(blog_html, blog):
+            continue
+        rendered = rendered + 1
+        if blog_html is None:
+            created.append(await make_blog_html(blog))
+        else:
+            await save_blog_html(blog, blog_html)
+    if created:
+        await BlogHtml.save_all(created)
+    return rendered
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    argv = sys.argv[1:]
+    if not argv or argv[0] != 'backfill':
+        print('Usage: python3 render.py backfill [batch]')
+        exit(0)
+    batch = int(argv[1]) if len(argv) > 1 else 100
+
+    from config import configs
+
+    async def main(loop):
+        await orm.create_pool(loop=loop, **configs.db)
+        await backfill(batch)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop))
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Write-behind buffers: queue inserts in memory and flush them in batches.
+'''
+
+__author__ = 'Liuyzh'
+
+import asyncio, contextvars, logging
+
+import orm
+
+#队列中的实例达到max_pending个时add()抛出此异常
+class BufferFull(Exception):
+    pass
+
+#某个Model的写缓冲，add()的实例先放在内存中，达到max_size个或等待interval秒后
+#用Model.save_all合并成多行insert写入数据库
+#durable=True时add()等到所在的批次写入后才返回，写入失败时抛出异常；
+#否则add()立即返回，写入失败(如数据库不可用)时放回队列，按指数退避重试，最长间隔max_backoff秒，
+#已确认的实例不会因为重试次数而丢弃，队列最多max_pending个
+#多行insert违反约束(如主键重复)时逐行写入，只丢弃出错的行
+#未写入的实例可以通过pending()读到
+#after_flush(objs)在写入的同一个事务中执行，如更新计数器
+class WriteBuffer(object):
+
+    def __init__(self, model, max_size=100, interval=0.5, durable=False, max_pending=10000, max_backoff=30, chunk_size=500, after_flush=None):
+        self.model = model
+        self.after_flush = after_flush
+        self.max_size = max_size
+        self.interval = interval
+        self.durable = durable
+        self.max_pending = max_pending
+        self.max_backoff = max_backoff
+        self.chunk_size = chunk_size
+        #等待写入的实例
+        self._pending = []
+        #正在写入的实例，写入完成前仍可以读到
+        self._flushing = []
+        #durable模式下等待写入结果的future，与_pending一一对应
+        self._waiters = []
+        self._timer = None
+        self._lock = asyncio.Lock()
+        self._failures = 0
+        self.buffered = 0
+        self.flushed = 0
+        self.batches = 0
+        self.dropped = 0
+
+    async def add(self, obj):
+        if len(self._pending) + len(self._flushing) >= self.max_pending:
+            raise BufferFull('%s write buffer is full.' % self.model.__table__)
+        #先填上主键、创建时间等默认值，未写入时也能按主键读取
+        for k in self.model.__fields__ + [self.model.__primary_key__]:
+            obj.getValueOrDefault(k)
+        self._pending.append(obj)
+        self.buffered = self.buffered + 1
+        waiter = None
+        if self.durable:
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+        #写入失败后等退避的定时器重试，不因队列变长而提前写入
+        if len(self._pending) >= self.max_size and not self._failures:
+            self._schedule()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.interval, self._schedule, context=contextvars.Context())
+        if waiter is not None:
+            await waiter
+        return obj
+
+    #在空的context中写入，不使用当前请求的事务和标识映射
+    def _schedule(self):
+        asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(self.flush()), context=contextvars.Context())
+
+    #在一个事务中写入实例并执行after_flush
+    async def _write(self, objs):
+        async with orm.transaction():
+            await self.model.save_all(objs, self.chunk_size)
+            if self.after_flush is not None:
+                await self.after_flush(objs)
+
+    #返回写入的实例数
+    async def flush(self):
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            objs, self._pending = self._pending, []
+            waiters, self._waiters = self._waiters, []
+            if not objs:
+                return 0
+            self._flushing = objs
+            #每个实例的写入错误，None表示已写入
+            errors = [None] * len(objs)
+            #需要稍后重试的实例
+            retry = []
+            try:
+                try:
+                    await self._write(objs)
+                except orm.IntegrityError as e:
+                    logging.warning('flush %s %s failed: %s, write them one by one.' % (len(objs), self.model.__table__, e))
+                    for i, obj in enumerate(objs):
+                        try:
+                            await self._write([obj])
+                        except orm.IntegrityError as e:
+                            errors[i] = e
+                            self.dropped = self.dropped + 1
+                            logging.error('drop %s %s: %s' % (self.model.__table__, obj.getValue(self.model.__primary_key__), e))
+                        except Exception as e:
+                            #数据库不可用等，剩余的实例稍后重试
+                            errors[i:] = [e] * (len(objs) - i)
+                            retry = objs[i:]
+                            break
+                except Exception as e:
+                    errors = [e] * len(objs)
+                    retry = objs
+            finally:
+                self._flushing = []
+            written = errors.count(None)
+            self.flushed = self.flushed + written
+            if written:
+                self.batches = self.batches + 1
+            if self.durable:
+                for w, e in zip(waiters, errors):
+                    if w.done():
+                        continue
+                    if e is None:
+                        w.set_result(None)
+                    else:
+                        w.set_exception(e)
+            elif retry:
+                #已确认的实例放回队列，按指数退避重试
+                self._failures = self._failures + 1
+                delay = min(self.interval * 2 ** self._failures, self.max_backoff)
+                logging.warning('flush %s %s failed (%s): %s, retry in %ss.' % (len(retry), self.model.__table__, self._failures, errors[-1], delay))
+                self._pending[0:0] = retry
+                self._timer = asyncio.get_event_loop().call_later(delay, self._schedule, context=contextvars.Context())
+                return written
+            self._failures = 0
+            return written
+
+    #未写入的实例中字段值与kw一致的，按加入的先后排列
+    def pending(self, **kw):
+        return [obj for obj in self._flushing + self._pending if all(obj.get(k) == v for k, v in kw.items())]
+
+    #从队列中删除还未开始写入的实例，返回是否删除
+    #实例正在写入时等这次写入结束: 成功时返回False，由调用者从数据库中删除；失败时实例已放回队列，从队列中删除
+    async def discard(self, pk):
+        key = self.model.__primary_key__
+        while True:
+            for i, obj in enumerate(self._pending):
+                if obj.getValue(key) == pk:
+                    del self._pending[i]
+                    if self.durable:
+                        waiter = self._waiters.pop(i)
+                        if not waiter.done():
+                            waiter.set_result(None)
+                    return True
+            if not any(obj.getValue(key) == pk for obj in self._flushing):
+                return False
+            async with self._lock:
+                pass
+
+    def stats(self):
+        return dict(table=self.model.__table__, pending=len(self._pending), flushing=len(self._flushing), buffered=self.buffered, flushed=self.flushed, batches=self.batches, dropped=self.dropped, failures=self._failures, durable=self.durable)
+
+#Model ==> WriteBuffer
+_buffers = dict()
+
+def start_buffer(model, enabled=True, **kw):
+    if not enabled:
+        return None
+    logging.info('start write buffer for %s...' % model.__table__)
+    _buffers[model] = WriteBuffer(model, **kw)
+    return _buffers[model]
+
+#没有启用时返回None
+def get_buffer(model):
+    return _buffers.get(model)
+
+#关闭服务器前写入所有缓冲
+async def flush_all():
+    for buf in _buffers.values():
+        await buf.flush()
+        if buf._pending:
+            logging.error('%s %s not written on shutdown: %s' % (len(buf._pending), buf.model.__table__, [obj.getValue(buf.model.__primary_key__) for obj in buf._pending]))
+
+def buffer_stats():
+    return [buf.stats() for buf in _buffers.values()]